@@ -70,6 +70,235 @@ def solve(graphfunc, costfunc, heurfunc, goaltestfunc, start):
     path.reverse()
     return path
 
+class GridSolver(object):
+    # A* over an 8-connected w x h grid whose node ids are x * h + y.
+    # Entering a node costs costTable[cells[node]] where 0 means impassable,
+    # and nodes for which blocked[node] is true can't be entered either.
+    # Edge costs are small integers, so the open list is a ring of buckets
+    # indexed by f cost (Dial's algorithm) instead of a heap.
+    neighbourOffsets = [(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)]
+
+    def __init__(self, w, h):
+        self.w = w
+        self.h = h
+        self._allocate()
+
+    def __getstate__(self):
+        return {'w': self.w, 'h': self.h}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._allocate()
+
+    def _allocate(self):
+        n = self.w * self.h
+        self.gcost = [0] * n
+        self.parents = [-1] * n
+        # gcost and parents of a node are only valid if its entry here
+        # matches the current search, so nothing needs clearing between runs
+        self.opened = [0] * n
+        self.closed = [0] * n
+        self.searchNum = 0
+        self.offsets = [(dx, dy, dx * self.h + dy) for dx, dy in GridSolver.neighbourOffsets]
+
+    def reshape(self, w, h):
+        # for a grid of another size; the node arrays are kept if they're
+        # large enough for it
+        if w == self.w and h == self.h:
+            return
+        if w * h > len(self.gcost):
+            self.w = w
+            self.h = h
+            self._allocate()
+            return
+        self.w = w
+        self.h = h
+        self.offsets = [(dx, dy, dx * h + dy) for dx, dy in GridSolver.neighbourOffsets]
+
+    def solve(self, cells, costTable, blocked, start, goal):
+        self.searchNum += 1
+        searchNum = self.searchNum
+        w, h = self.w, self.h
+        gcost, parents, opened, closed = self.gcost, self.parents, self.opened, self.closed
+        offsets = self.offsets
+
+        edgeCosts = [c for c in costTable if c > 0]
+        minCost = min(edgeCosts)
+        numBuckets = max(edgeCosts) + minCost + 1
+        buckets = [list() for i in xrange(numBuckets)]
+
+        gx, gy = divmod(goal, h)
+        sx, sy = divmod(start, h)
+        f = minCost * max(abs(gx - sx), abs(gy - sy))
+        gcost[start] = 0
+        parents[start] = -1
+        opened[start] = searchNum
+        buckets[f % numBuckets].append(start)
+        pending = 1
+        found = False
+
+        while pending:
+            bucket = buckets[f % numBuckets]
+            while bucket:
+                current = bucket.pop()
+                pending -= 1
+                if closed[current] == searchNum:
+                    continue
+                closed[current] = searchNum
+                if current == goal:
+                    found = True
+                    break
+
+                cx, cy = divmod(current, h)
+                border = cx == 0 or cy == 0 or cx == w - 1 or cy == h - 1
+                g = gcost[current]
+                for dx, dy, di in offsets:
+                    if border:
+                        nx = cx + dx
+                        ny = cy + dy
+                        if nx < 0 or ny < 0 or nx >= w or ny >= h:
+                            continue
+                    child = current + di
+                    if closed[child] == searchNum:
+                        continue
+                    edgeCost = costTable[cells[child]]
+                    if not edgeCost or blocked[child]:
+                        continue
+                    thisGCost = g + edgeCost
+                    if opened[child] == searchNum and gcost[child] <= thisGCost:
+                        continue
+                    opened[child] = searchNum
+                    gcost[child] = thisGCost
+                    parents[child] = current
+                    hx = abs(gx - cx - dx)
+                    hy = abs(gy - cy - dy)
+                    childF = thisGCost + minCost * (hx if hx > hy else hy)
+                    buckets[childF % numBuckets].append(child)
+                    pending += 1
+            if found:
+                break
+            f += 1
+
+        if not found:
+            return None
+
+        path = [goal]
+        curr = goal
+        while parents[curr] != -1:
+            curr = parents[curr]
+            path.append(curr)
+        path.reverse()
+        return path
+
+    def flood(self, cells, costTable, blocked, start, maxCost):
+        # Dijkstra from start over every node reachable for at most maxCost.
+        # Returns dicts of cost and parent per reached node, and whether any
+        # node was left out because of maxCost.
+        h, w = self.h, self.w
+        offsets = self.offsets
+        costs = {start: 0}
+        parents = {start: -1}
+        truncated = False
+
+        numBuckets = max(costTable) + 1
+        buckets = [list() for i in xrange(numBuckets)]
+        buckets[0].append(start)
+        pending = 1
+        g = 0
+
+        while pending:
+            bucket = buckets[g % numBuckets]
+            while bucket:
+                current = bucket.pop()
+                pending -= 1
+                if costs[current] != g:
+                    continue
+
+                cx, cy = divmod(current, h)
+                border = cx == 0 or cy == 0 or cx == w - 1 or cy == h - 1
+                for dx, dy, di in offsets:
+                    if border:
+                        nx = cx + dx
+                        ny = cy + dy
+                        if nx < 0 or ny < 0 or nx >= w or ny >= h:
+                            continue
+                    child = current + di
+                    edgeCost = costTable[cells[child]]
+                    if not edgeCost or blocked[child]:
+                        continue
+                    thisGCost = g + edgeCost
+                    if thisGCost > maxCost:
+                        truncated = True
+                        continue
+                    if costs.get(child, thisGCost + 1) <= thisGCost:
+                        continue
+                    costs[child] = thisGCost
+                    parents[child] = current
+                    buckets[thisGCost % numBuckets].append(child)
+                    pending += 1
+            g += 1
+
+        return costs, parents, truncated
+
+    def voronoi(self, cells, costTable, blocked, sources):
+        # Dijkstra from all sources at once. Returns lists of, per node, the
+        # cost from the nearest source, the index of that source in sources
+        # and the parent towards it. Nodes that weren't reached have owner
+        # -1; sources have parent -1. A source that is a duplicate of an
+        # earlier one owns nothing.
+        h, w = self.h, self.w
+        offsets = self.offsets
+        n = w * h
+        costs = [0] * n
+        owners = [-1] * n
+        parents = [-1] * n
+
+        numBuckets = max(costTable) + 1
+        buckets = [list() for i in xrange(numBuckets)]
+        for i, source in enumerate(sources):
+            if owners[source] == -1:
+                owners[source] = i
+                buckets[0].append(source)
+        pending = len(buckets[0])
+        g = 0
+
+        while pending:
+            bucket = buckets[g % numBuckets]
+            while bucket:
+                current = bucket.pop()
+                pending -= 1
+                if costs[current] != g:
+                    continue
+
+                owner = owners[current]
+                cx, cy = divmod(current, h)
+                border = cx == 0 or cy == 0 or cx == w - 1 or cy == h - 1
+                for dx, dy, di in offsets:
+                    if border:
+                        nx = cx + dx
+                        ny = cy + dy
+                        if nx < 0 or ny < 0 or nx >= w or ny >= h:
+                            continue
+                    child = current + di
+                    edgeCost = costTable[cells[child]]
+                    if not edgeCost or blocked[child]:
+                        continue
+                    thisGCost = g + edgeCost
+                    if owners[child] != -1 and costs[child] <= thisGCost:
+                        continue
+                    costs[child] = thisGCost
+                    owners[child] = owner
+                    parents[child] = current
+                    buckets[thisGCost % numBuckets].append(child)
+                    pending += 1
+            g += 1
+
+        return costs, owners, parents
+
+    def costTo(self, node):
+        # real cost of a node on the path returned by the last solve()
+        return self.gcost[node]
+
 def main():
     def gf(n):
         if n == (0, 0):
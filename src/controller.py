@@ -2,7 +2,6 @@
 
 import curses
 import string
-import cPickle as pickle
 
 import model
 
@@ -194,7 +193,7 @@ class Controller(model.BattlefieldListener):
 
     def _saveGame(self):
         with open('game.sav', 'wb') as f:
-            pickle.dump(self.saveable, f)
+            self.saveable.save(f)
         self.cstate.message = 'Game saved.'
 
     def _handleAction(self, c):
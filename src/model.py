@@ -1,10 +1,26 @@
 #!/usr/bin/env python2.7
 
+import os
+import mmap
 import random
 import collections
+import contextlib
+import itertools
+import binascii
+import hashlib
 import math
 import time
 import string
+import struct
+import multiprocessing
+import threading
+import Queue
+import traceback
+import tempfile
+import fcntl
+import shutil
+import atexit
+import cPickle as pickle
 
 import astar
 import log
@@ -44,6 +60,450 @@ class Tile(object):
     def passable(self):
         return self.overlay == Tile.Overlay.NoOverlay
 
+    def opacity(self):
+        if self.overlay == Tile.Overlay.NoOverlay:
+            return 0.05
+        elif self.overlay == Tile.Overlay.Tree:
+            return 0.35
+        elif self.overlay == Tile.Overlay.Wall:
+            return 1.0
+        assert False, 'No visibility information for %d' % self.overlay
+
+    @staticmethod
+    def pack(base, overlay):
+        return base | (overlay << TerrainGrid.OverlayShift)
+
+class TileRef(Tile):
+    # Tile-like accessor for a single cell of a TerrainGrid.
+    def __init__(self, grid, x, y):
+        self.grid = grid
+        self.x = x
+        self.y = y
+
+    @property
+    def base(self):
+        return self.grid.base(self.x, self.y)
+
+    @base.setter
+    def base(self, value):
+        self.grid.setBase(self.x, self.y, value)
+
+    @property
+    def overlay(self):
+        return self.grid.overlay(self.x, self.y)
+
+    @overlay.setter
+    def overlay(self, value):
+        self.grid.setOverlay(self.x, self.y, value)
+
+class TerrainColumn(object):
+    def __init__(self, grid, x):
+        self.grid = grid
+        self.x = x
+
+    def __getitem__(self, y):
+        return TileRef(self.grid, self.x, y)
+
+    def __setitem__(self, y, tile):
+        self.grid.set(self.x, y, tile.base, tile.overlay)
+
+def _cellTable(func):
+    # one entry per packed (base, overlay) value
+    ret = list()
+    for cell in xrange(1 << (2 * TerrainGrid.OverlayShift)):
+        tile = Tile(cell & TerrainGrid.BaseMask, cell >> TerrainGrid.OverlayShift)
+        try:
+            ret.append(func(tile))
+        except (InvalidMovementError, AssertionError):
+            ret.append(0)
+    return ret
+
+class TerrainComponents(object):
+    # Labels of the 8-connected regions of passable terrain, ignoring
+    # soldiers. 0 is the label of impassable tiles. The labels are built on
+    # first use and from then on updated as single tiles change passability.
+    def __init__(self, grid):
+        self.grid = grid
+        self.labels = None
+        self.sizes = dict()
+        self.nextLabel = 1
+
+    def label(self, index):
+        if self.labels is None:
+            self._build()
+        return self.labels[index]
+
+    def reset(self):
+        self.labels = None
+
+    def __getstate__(self):
+        # the labels are rebuilt on first use
+        state = self.__dict__.copy()
+        state['labels'] = None
+        return state
+
+    def _build(self):
+        self.labels = [0] * len(self.grid.cells)
+        self.sizes = dict()
+        for i in xrange(len(self.labels)):
+            if self.labels[i] == 0 and self._passable(i):
+                self._fill(i, 0, self._newLabel())
+
+    def _passable(self, index):
+        return TerrainGrid.movementCosts[self.grid.cells[index]] != 0
+
+    def _newLabel(self):
+        label = self.nextLabel
+        self.nextLabel += 1
+        self.sizes[label] = 0
+        return label
+
+    def _neighbours(self, index):
+        w, h = self.grid.w, self.grid.h
+        x, y = divmod(index, h)
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                nx = x + dx
+                ny = y + dy
+                if (dx or dy) and nx >= 0 and ny >= 0 and nx < w and ny < h:
+                    yield nx * h + ny
+
+    def _fill(self, start, fromLabel, toLabel):
+        # relabel the region of fromLabel around start; fromLabel 0 means
+        # unlabelled passable tiles
+        labels = self.labels
+        cells = self.grid.cells
+        costs = TerrainGrid.movementCosts
+        w, h = self.grid.w, self.grid.h
+        offsets = [(dx, dy, dx * h + dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1) if dx or dy]
+        labels[start] = toLabel
+        stack = [start]
+        count = 1
+        while stack:
+            current = stack.pop()
+            x, y = divmod(current, h)
+            border = x == 0 or y == 0 or x == w - 1 or y == h - 1
+            for dx, dy, di in offsets:
+                if border:
+                    nx = x + dx
+                    ny = y + dy
+                    if nx < 0 or ny < 0 or nx >= w or ny >= h:
+                        continue
+                n = current + di
+                if labels[n] == fromLabel and (fromLabel or costs[cells[n]]):
+                    labels[n] = toLabel
+                    stack.append(n)
+                    count += 1
+        self.sizes[toLabel] += count
+        if fromLabel:
+            self.sizes[fromLabel] -= count
+            if self.sizes[fromLabel] == 0:
+                del self.sizes[fromLabel]
+        return count
+
+    def tileChanged(self, index):
+        if self.labels is None:
+            return
+        labels = self.labels
+        if self._passable(index):
+            if labels[index]:
+                return
+            joined = set(labels[n] for n in self._neighbours(index)) - set([0])
+            if not joined:
+                label = self._newLabel()
+            else:
+                # merge into the biggest neighbouring region
+                label = max(joined, key=lambda l: self.sizes[l])
+                for n in self._neighbours(index):
+                    if labels[n] and labels[n] != label:
+                        self._fill(n, labels[n], label)
+            labels[index] = label
+            self.sizes[label] += 1
+        else:
+            label = labels[index]
+            if not label:
+                return
+            labels[index] = 0
+            self.sizes[label] -= 1
+            ring = [n for n in self._neighbours(index) if labels[n] == label]
+            if ring and self._ringConnected(ring):
+                return
+            # the region may have been split; give each part its own label
+            for n in ring:
+                if labels[n] == label:
+                    self._fill(n, label, self._newLabel())
+            self.sizes.pop(label, None)
+
+    def _ringConnected(self, ring):
+        # Whether the tiles around a tile are connected to each other
+        # without it. If so, any route through the tile can go around it,
+        # so taking it out of its region can't split the region.
+        h = self.grid.h
+        coords = [divmod(n, h) for n in ring]
+        reached = set(coords[:1])
+        stack = coords[:1]
+        while stack:
+            x, y = stack.pop()
+            for c in coords:
+                if c not in reached and abs(c[0] - x) <= 1 and abs(c[1] - y) <= 1:
+                    reached.add(c)
+                    stack.append(c)
+        return len(reached) == len(coords)
+
+class TerrainGrid(object):
+    # Cells are stored column by column (index = x * h + y) in a bytearray,
+    # each packing the base in the low two bits and the overlay above them.
+    BaseMask = 0x03
+    OverlayShift = 2
+    chunked = False
+
+    def __init__(self, w, h, base=Tile.Base.Grass, overlay=Tile.Overlay.NoOverlay):
+        self.w = w
+        self.h = h
+        self.cells = bytearray([Tile.pack(base, overlay)]) * (w * h)
+        # bumped on every edit so that derived data can tell it's stale
+        self.version = 0
+        self.components = TerrainComponents(self)
+
+    def __getitem__(self, x):
+        if x < 0 or x >= self.w:
+            raise IndexError(x)
+        return TerrainColumn(self, x)
+
+    def index(self, x, y):
+        return x * self.h + y
+
+    def coord(self, index):
+        return divmod(index, self.h)
+
+    def cell(self, x, y):
+        return self.cells[x * self.h + y]
+
+    def base(self, x, y):
+        return self.cells[x * self.h + y] & TerrainGrid.BaseMask
+
+    def overlay(self, x, y):
+        return self.cells[x * self.h + y] >> TerrainGrid.OverlayShift
+
+    def set(self, x, y, base, overlay):
+        index = x * self.h + y
+        oldCell = self.cells[index]
+        cell = Tile.pack(base, overlay)
+        self.cells[index] = cell
+        self.version += 1
+        if (TerrainGrid.movementCosts[oldCell] == 0) != (TerrainGrid.movementCosts[cell] == 0):
+            self.components.tileChanged(index)
+
+    def setBase(self, x, y, base):
+        self.set(x, y, base, self.overlay(x, y))
+
+    # Bulk edits work on whole column slices at once. They don't track
+    # single tiles, so the component labels are rebuilt on next use.
+    def cellsChanged(self):
+        self.version += 1
+        self.components.reset()
+
+    def setCells(self, cells):
+        assert len(cells) == len(self.cells)
+        self.cells = bytearray(cells)
+        self.cellsChanged()
+
+    def fillColumn(self, x, y0, y1, base, overlay):
+        # edges included
+        start = x * self.h
+        self.cells[start + y0:start + y1 + 1] = bytearray([Tile.pack(base, overlay)]) * (y1 - y0 + 1)
+        self.cellsChanged()
+
+    def fillRect(self, x0, y0, x1, y1, base, overlay):
+        for x in xrange(x0, x1 + 1):
+            self.fillColumn(x, y0, y1, base, overlay)
+
+    def translateColumn(self, x, y0, y1, table):
+        # maps the cells through a 256 byte table from cellTable()
+        start = x * self.h
+        self.cells[start + y0:start + y1 + 1] = self.cells[start + y0:start + y1 + 1].translate(table)
+        self.cellsChanged()
+
+    @staticmethod
+    def cellTable(func):
+        # translation table for func(base, overlay) -> (base, overlay)
+        ret = list()
+        for cell in xrange(256):
+            base, overlay = func(cell & TerrainGrid.BaseMask, cell >> TerrainGrid.OverlayShift)
+            ret.append(chr(Tile.pack(base, overlay)))
+        return ''.join(ret)
+
+    def setOverlay(self, x, y, overlay):
+        self.set(x, y, self.base(x, y), overlay)
+
+    def passable(self, x, y):
+        return TerrainGrid.movementCosts[self.cells[x * self.h + y]] != 0
+
+    def movementCost(self, x, y):
+        cost = TerrainGrid.movementCosts[self.cells[x * self.h + y]]
+        if not cost:
+            raise InvalidMovementError()
+        return cost
+
+    def opacity(self, x, y):
+        return TerrainGrid.opacities[self.cells[x * self.h + y]]
+
+    def connected(self, a, b):
+        # whether there's any passable route between the two tiles, not
+        # counting soldiers; impassable tiles are connected to nothing
+        la = self.components.label(a[0] * self.h + a[1])
+        return la != 0 and la == self.components.label(b[0] * self.h + b[1])
+
+    def window(self, x0, y0, x1, y1):
+        # A flat grid covering at least the area, and the position of its
+        # top left corner. This grid is flat already, so it's the whole grid.
+        return self, 0, 0
+
+    def retain(self, areas):
+        pass
+
+# movement cost is 0 for impassable cells
+TerrainGrid.movementCosts = _cellTable(Tile.movementCost)
+TerrainGrid.opacities = _cellTable(Tile.opacity)
+
+class ChunkedTerrainGrid(object):
+    # The same interface as TerrainGrid for battlefields too large to keep
+    # in one array. The cells are kept in chunkSize x chunkSize chunks laid
+    # out like TerrainGrid, made by source(cx, cy) when first touched.
+    # Chunks that haven't been edited are released by retain() when far
+    # from everything of interest, and made again when needed. Searches
+    # work on flat copies of the area they need from window(). There are
+    # no component labels, so connected() only checks passability.
+    defaultChunkSize = 32
+    chunked = True
+
+    def __init__(self, w, h, source, chunkSize=defaultChunkSize):
+        self.w = w
+        self.h = h
+        self.source = source
+        self.chunkSize = chunkSize
+        self.chunks = dict()
+        self.dirty = set()
+        self.version = 0
+        self.components = None
+        self.loads = 0
+        self.releases = 0
+
+    def __getstate__(self):
+        # clean chunks can always be made again
+        state = self.__dict__.copy()
+        state['chunks'] = dict((key, self.chunks[key]) for key in self.dirty)
+        return state
+
+    def __getitem__(self, x):
+        if x < 0 or x >= self.w:
+            raise IndexError(x)
+        return TerrainColumn(self, x)
+
+    def index(self, x, y):
+        return x * self.h + y
+
+    def coord(self, index):
+        return divmod(index, self.h)
+
+    def _chunk(self, cx, cy):
+        try:
+            return self.chunks[cx, cy]
+        except KeyError:
+            chunk = self.source(cx, cy)
+            assert len(chunk) == self.chunkSize * self.chunkSize
+            self.chunks[cx, cy] = chunk
+            self.loads += 1
+            return chunk
+
+    def cell(self, x, y):
+        cx, lx = divmod(x, self.chunkSize)
+        cy, ly = divmod(y, self.chunkSize)
+        return self._chunk(cx, cy)[lx * self.chunkSize + ly]
+
+    def base(self, x, y):
+        return self.cell(x, y) & TerrainGrid.BaseMask
+
+    def overlay(self, x, y):
+        return self.cell(x, y) >> TerrainGrid.OverlayShift
+
+    def set(self, x, y, base, overlay):
+        cx, lx = divmod(x, self.chunkSize)
+        cy, ly = divmod(y, self.chunkSize)
+        self._chunk(cx, cy)[lx * self.chunkSize + ly] = Tile.pack(base, overlay)
+        self.dirty.add((cx, cy))
+        self.version += 1
+
+    def setBase(self, x, y, base):
+        self.set(x, y, base, self.overlay(x, y))
+
+    def setOverlay(self, x, y, overlay):
+        self.set(x, y, self.base(x, y), overlay)
+
+    def cellsChanged(self):
+        self.version += 1
+
+    def fillColumn(self, x, y0, y1, base, overlay):
+        for y in xrange(y0, y1 + 1):
+            self.set(x, y, base, overlay)
+
+    def fillRect(self, x0, y0, x1, y1, base, overlay):
+        for x in xrange(x0, x1 + 1):
+            self.fillColumn(x, y0, y1, base, overlay)
+
+    def translateColumn(self, x, y0, y1, table):
+        for y in xrange(y0, y1 + 1):
+            cell = ord(table[self.cell(x, y)])
+            self.set(x, y, cell & TerrainGrid.BaseMask, cell >> TerrainGrid.OverlayShift)
+
+    def passable(self, x, y):
+        return TerrainGrid.movementCosts[self.cell(x, y)] != 0
+
+    def movementCost(self, x, y):
+        cost = TerrainGrid.movementCosts[self.cell(x, y)]
+        if not cost:
+            raise InvalidMovementError()
+        return cost
+
+    def opacity(self, x, y):
+        return TerrainGrid.opacities[self.cell(x, y)]
+
+    def connected(self, a, b):
+        return self.passable(a[0], a[1]) and self.passable(b[0], b[1])
+
+    def window(self, x0, y0, x1, y1):
+        # a flat copy of the area, clipped to the grid
+        x0 = max(0, x0)
+        y0 = max(0, y0)
+        x1 = min(self.w - 1, x1)
+        y1 = min(self.h - 1, y1)
+        grid = TerrainGrid(x1 - x0 + 1, y1 - y0 + 1)
+        cells = grid.cells
+        cs = self.chunkSize
+        for x in xrange(x0, x1 + 1):
+            cx, lx = divmod(x, cs)
+            col = (x - x0) * grid.h - y0
+            for cy in xrange(y0 // cs, y1 // cs + 1):
+                top = max(y0, cy * cs)
+                bottom = min(y1, cy * cs + cs - 1)
+                start = lx * cs + top - cy * cs
+                cells[col + top:col + bottom + 1] = self._chunk(cx, cy)[start:start + bottom - top + 1]
+        return grid, x0, y0
+
+    def retain(self, areas):
+        # releases the unedited chunks that aren't within a chunk of any of
+        # the (x0, y0, x1, y1) areas
+        cs = self.chunkSize
+        keep = set()
+        for x0, y0, x1, y1 in areas:
+            for cx in xrange(x0 // cs - 1, x1 // cs + 2):
+                for cy in xrange(y0 // cs - 1, y1 // cs + 2):
+                    keep.add((cx, cy))
+        for key in self.chunks.keys():
+            if key not in keep and key not in self.dirty:
+                del self.chunks[key]
+                self.releases += 1
+
 class WeaponType(object):
     Magnum357 = 0
     RifleG12 = 1
@@ -90,10 +550,10 @@ class SoldierAttributes(object):
         self.health = health
         self.marksmanship = marksmanship
 
-def getSoldierAttributes(enemy, names):
-    stamina = random.randrange(50, 90)
-    health = random.randrange(50, 90)
-    marksmanship = random.randrange(20, 90)
+def getSoldierAttributes(enemy, names, rng=random):
+    stamina = rng.randrange(50, 90)
+    health = rng.randrange(50, 90)
+    marksmanship = rng.randrange(20, 90)
     if enemy:
         name = 'enemy'
     else:
@@ -113,9 +573,13 @@ class Soldier(object):
         self.inventory = dict()
         self.wieldedItem = None
         self.health = self.attributes.health
+        self.battlefield = None
 
     def setPosition(self, pos):
+        oldpos = self.x, self.y
         self.x, self.y = pos[0], pos[1]
+        if self.battlefield:
+            self.battlefield.soldierMoved(self, oldpos)
 
     def getPosition(self):
         return self.x, self.y
@@ -130,6 +594,9 @@ class Soldier(object):
             self.health = 0
         if self.health == 0:
             self.aps = 0
+            if self.battlefield:
+                self.battlefield.soldierDied(self)
+        self._statsChanged()
 
     def alive(self):
         return self.health > 0
@@ -155,13 +622,19 @@ class Soldier(object):
             self.aps = self.attributes.stamina * Soldier.MaxAPs / 100
             self.aps += min(5, restAPs)
             self.aps = min(Soldier.MaxAPs, self.aps)
+            self._statsChanged()
 
     def useAPs(self, cost):
         if cost > self.aps:
             return False
         self.aps -= cost
+        self._statsChanged()
         return True
 
+    def _statsChanged(self):
+        if self.battlefield:
+            self.battlefield.soldierStatsChanged(self)
+
     def pickup(self, item):
         return self.addToInventory(item)
 
@@ -197,6 +670,371 @@ class Soldier(object):
     def hasAPsToPickup(self):
         return self.aps >= Soldier.APsToPickup
 
+class OccupancyGrid(object):
+    # Alive soldiers indexed by position, laid out like TerrainGrid.
+    def __init__(self, w, h):
+        self.w = w
+        self.h = h
+        self.cells = [None] * (w * h)
+        self.version = 0
+
+    def soldierAt(self, x, y):
+        return self.cells[x * self.h + y]
+
+    def add(self, soldier):
+        index = soldier.x * self.h + soldier.y
+        assert self.cells[index] is None, 'tile %s is taken' % (soldier.getPosition(),)
+        self.cells[index] = soldier
+        self.version += 1
+
+    def remove(self, soldier, pos=None):
+        if pos is None:
+            pos = soldier.getPosition()
+        index = pos[0] * self.h + pos[1]
+        if self.cells[index] is soldier:
+            self.cells[index] = None
+            self.version += 1
+
+    def move(self, soldier, oldpos):
+        self.remove(soldier, oldpos)
+        self.add(soldier)
+
+    def atIndex(self, index):
+        return self.cells[index]
+
+    def window(self, x0, y0, w, h):
+        # the part of cells covering the w x h area at x0, y0
+        if x0 == 0 and y0 == 0 and w == self.w and h == self.h:
+            return self.cells
+        ret = list()
+        for x in xrange(x0, x0 + w):
+            start = x * self.h + y0
+            ret.extend(self.cells[start:start + h])
+        return ret
+
+class SparseOccupancyGrid(object):
+    # OccupancyGrid for battlefields too large for a list entry per tile.
+    def __init__(self, w, h):
+        self.w = w
+        self.h = h
+        self.soldiers = dict()
+        self.version = 0
+
+    def soldierAt(self, x, y):
+        return self.soldiers.get(x * self.h + y)
+
+    def atIndex(self, index):
+        return self.soldiers.get(index)
+
+    def add(self, soldier):
+        index = soldier.x * self.h + soldier.y
+        assert index not in self.soldiers, 'tile %s is taken' % (soldier.getPosition(),)
+        self.soldiers[index] = soldier
+        self.version += 1
+
+    def remove(self, soldier, pos=None):
+        if pos is None:
+            pos = soldier.getPosition()
+        index = pos[0] * self.h + pos[1]
+        if self.soldiers.get(index) is soldier:
+            del self.soldiers[index]
+            self.version += 1
+
+    def move(self, soldier, oldpos):
+        self.remove(soldier, oldpos)
+        self.add(soldier)
+
+    def window(self, x0, y0, w, h):
+        ret = [None] * (w * h)
+        for index, soldier in self.soldiers.iteritems():
+            x, y = divmod(index, self.h)
+            if x >= x0 and y >= y0 and x < x0 + w and y < y0 + h:
+                ret[(x - x0) * h + y - y0] = soldier
+        return ret
+
+class SpatialIndex(object):
+    # Objects bucketed by position into squares of bucketSize tiles, to find
+    # what's in an area without looking at everything. Buckets are lists so
+    # that results come out in a stable order.
+    def __init__(self, bucketSize=8):
+        self.bucketSize = bucketSize
+        self.buckets = dict()
+        self.positions = dict()
+
+    def _key(self, pos):
+        return pos[0] // self.bucketSize, pos[1] // self.bucketSize
+
+    def add(self, obj, pos):
+        self.positions[obj] = pos
+        self.buckets.setdefault(self._key(pos), list()).append(obj)
+
+    def remove(self, obj):
+        pos = self.positions.pop(obj, None)
+        if pos is None:
+            return
+        key = self._key(pos)
+        bucket = self.buckets[key]
+        bucket.remove(obj)
+        if not bucket:
+            del self.buckets[key]
+
+    def move(self, obj, pos):
+        oldpos = self.positions.get(obj)
+        if oldpos is not None and self._key(oldpos) == self._key(pos):
+            self.positions[obj] = pos
+        else:
+            self.remove(obj)
+            self.add(obj, pos)
+
+    def inArea(self, x0, y0, x1, y1):
+        # objects within the rectangle, edges included
+        ret = list()
+        bs = self.bucketSize
+        for bx in xrange(x0 // bs, x1 // bs + 1):
+            for by in xrange(y0 // bs, y1 // bs + 1):
+                bucket = self.buckets.get((bx, by))
+                if not bucket:
+                    continue
+                for obj in bucket:
+                    x, y = self.positions[obj]
+                    if x >= x0 and y >= y0 and x <= x1 and y <= y1:
+                        ret.append(obj)
+        return ret
+
+    def near(self, pos, radius):
+        return self.inArea(pos[0] - radius, pos[1] - radius, pos[0] + radius, pos[1] + radius)
+
+class PathCache(object):
+    # LRU cache of path query results, counting hits and misses.
+    def __init__(self, size=256):
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        try:
+            value = self.entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            raise
+        self.entries[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = value
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def hitRate(self):
+        queries = self.hits + self.misses
+        if not queries:
+            return 0.0
+        return self.hits / float(queries)
+
+class ReachMap(object):
+    # Every tile a soldier can reach with its current APs, with the cost and
+    # predecessor of each, from a single bounded flood.
+    def __init__(self, bf, soldier):
+        self.bf = bf
+        self.soldier = soldier
+        self.key = ReachMap.makeKey(bf, soldier)
+        aps = soldier.getAPs()
+        # no step costs less than the cheapest terrain
+        r = aps // min(c for c in TerrainGrid.movementCosts if c) + 1
+        self.grid, blocked, solver, self.ox, self.oy = bf.searchArea(soldier.x - r, soldier.y - r,
+                soldier.x + r, soldier.y + r)
+        self.start = self._node(soldier.x, soldier.y)
+        self.costs, self.parents, self.truncated = solver.flood(self.grid.cells,
+                TerrainGrid.movementCosts, blocked, self.start, aps)
+
+    @staticmethod
+    def makeKey(bf, soldier):
+        return soldier.getPosition(), soldier.getAPs(), bf.terrain.version, bf.occupancy.version
+
+    def valid(self):
+        return self.key == ReachMap.makeKey(self.bf, self.soldier)
+
+    def _node(self, x, y):
+        x -= self.ox
+        y -= self.oy
+        if x < 0 or y < 0 or x >= self.grid.w or y >= self.grid.h:
+            return None
+        return self.grid.index(x, y)
+
+    def _coord(self, node):
+        x, y = self.grid.coord(node)
+        return x + self.ox, y + self.oy
+
+    def reachable(self, x, y):
+        # like getPath(), the soldier's own tile doesn't count as reachable
+        node = self._node(x, y)
+        return node is not None and node != self.start and node in self.costs
+
+    def complete(self):
+        # if nothing was cut off by the AP limit, every tile that isn't in
+        # the map is unreachable
+        return not self.truncated
+
+    def costTo(self, x, y):
+        if not self.reachable(x, y):
+            return None
+        return self.costs[self._node(x, y)]
+
+    def _nodesTo(self, x, y):
+        if not self.reachable(x, y):
+            return None
+        node = self._node(x, y)
+        nodes = [node]
+        while self.parents[node] != -1:
+            node = self.parents[node]
+            nodes.append(node)
+        nodes.reverse()
+        return nodes
+
+    def pathTo(self, x, y):
+        nodes = self._nodesTo(x, y)
+        if nodes is None:
+            return None
+        return [self._coord(n) for n in nodes]
+
+    def pathWithCostsTo(self, x, y):
+        nodes = self._nodesTo(x, y)
+        if nodes is None:
+            return None
+        return [(self._coord(n), self.costs[n]) for n in nodes]
+
+class FieldOfView(object):
+    # Visibility of every tile around a position in one pass, by recursive
+    # shadowcasting over four quadrants. Each row of a beam is split into
+    # runs of tiles of equal opacity, and each run lights the next row with
+    # its opacity taken off, so every tile on the way costs 0.05, 0.35 or
+    # 1.0 like it did along a traced line. Slopes are integer fractions.
+    quadrants = [(0, -1, 1, 0), (1, 0, 0, 1), (0, 1, 1, 0), (-1, 0, 0, 1)]
+
+    def __init__(self, terrain, pos, sightRange):
+        self.terrain = terrain
+        self.pos = pos
+        self.sightRange = sightRange
+        # the scan runs on a flat grid of the area in sight, which for
+        # flat terrain is the terrain itself
+        self.grid, ox, oy = terrain.window(pos[0] - sightRange, pos[1] - sightRange,
+                pos[0] + sightRange, pos[1] + sightRange)
+        self.origin = pos[0] - ox, pos[1] - oy
+        self.visible = dict()
+        self.visible[self.grid.index(self.origin[0], self.origin[1])] = 1.0
+        for quadrant in FieldOfView.quadrants:
+            self._scan(quadrant, 1, (-1, 1), (1, 1), 1.0)
+        if self.grid is not terrain:
+            h = self.grid.h
+            self.visible = dict(((i // h + ox) * terrain.h + i % h + oy, v)
+                    for i, v in self.visible.iteritems())
+        self.grid = None
+
+    def _scan(self, quadrant, depth, start, end, visibility):
+        if depth > self.sightRange:
+            return
+        terrain = self.grid
+        cells = terrain.cells
+        opacities = TerrainGrid.opacities
+        visible = self.visible
+        rx, ry, cx, cy = quadrant
+        ox, oy = self.origin
+        startNum, startDen = start
+        endNum, endDen = end
+        # columns whose centres are within the beam, ties rounded inwards
+        minCol = (2 * depth * startNum + startDen) // (2 * startDen)
+        maxCol = -((endDen - 2 * depth * endNum) // (2 * endDen))
+
+        runStart = start
+        prevOpacity = None
+        for col in xrange(minCol, maxCol + 1):
+            x = ox + rx * depth + cx * col
+            y = oy + ry * depth + cy * col
+            if x < 0 or y < 0 or x >= terrain.w or y >= terrain.h:
+                opacity = 1.0
+            else:
+                index = x * terrain.h + y
+                opacity = opacities[cells[index]]
+                if opacity >= 1.0 or (col * startDen >= depth * startNum and col * endDen <= depth * endNum):
+                    if visible.get(index, 0.0) < visibility:
+                        visible[index] = visibility
+            if prevOpacity is not None and opacity != prevOpacity:
+                edge = (2 * col - 1, 2 * depth)
+                self._light(quadrant, depth, runStart, edge, visibility, prevOpacity)
+                runStart = edge
+            prevOpacity = opacity
+        if prevOpacity is not None:
+            self._light(quadrant, depth, runStart, end, visibility, prevOpacity)
+
+    def _light(self, quadrant, depth, start, end, visibility, opacity):
+        visibility -= opacity
+        if visibility > 0.0:
+            self._scan(quadrant, depth + 1, start, end, visibility)
+
+    def visibility(self, x, y):
+        if x < 0 or y < 0 or x >= self.terrain.w or y >= self.terrain.h:
+            return 0.0
+        return self.visible.get(self.terrain.index(x, y), 0.0)
+
+    def sees(self, pos):
+        return self.visibility(pos[0], pos[1]) > 0.0
+
+    def newlyVisible(self, previous):
+        # tiles visible here but not in the previous field of view
+        return [i for i in self.visible if i not in previous.visible]
+
+class TeamVisibility(object):
+    # The number of soldiers of a team that see each tile. Soldiers are
+    # marked dirty when they move, die, arrive or leave, and only their
+    # contribution is redone on the next query.
+    def __init__(self, bf, team):
+        self.bf = bf
+        self.team = team
+        self.counts = dict()
+        self.fovs = dict()
+        self.dirty = set(bf.soldiersInTeam(team))
+        self.terrainVersion = bf.terrain.version
+
+    def soldierChanged(self, soldier):
+        if soldier.team == self.team:
+            self.dirty.add(soldier)
+
+    def _add(self, fov):
+        counts = self.counts
+        for i in fov.visible:
+            counts[i] = counts.get(i, 0) + 1
+
+    def _remove(self, fov):
+        counts = self.counts
+        for i in fov.visible:
+            n = counts[i] - 1
+            if n:
+                counts[i] = n
+            else:
+                del counts[i]
+
+    def sync(self):
+        if self.terrainVersion != self.bf.terrain.version:
+            self.terrainVersion = self.bf.terrain.version
+            self.counts = dict()
+            self.fovs = dict()
+            self.dirty = set(self.bf.soldiersInTeam(self.team))
+        while self.dirty:
+            soldier = self.dirty.pop()
+            old = self.fovs.pop(soldier, None)
+            if old:
+                self._remove(old)
+            if soldier.alive() and soldier.battlefield is self.bf:
+                fov = self.bf.fieldOfView(soldier)
+                self._add(fov)
+                self.fovs[soldier] = fov
+
+    def sees(self, pos):
+        self.sync()
+        return self.bf.terrain.index(pos[0], pos[1]) in self.counts
+
 class BattlefieldListener(object):
     def currentSoldierChanged(self):
         pass
@@ -204,22 +1042,89 @@ class BattlefieldListener(object):
     def turnEnded(self, currentTeam):
         pass
 
+_diskSpans = dict()
+
+def diskSpans(rad):
+    # The disk of radius rad in a 2rad x 2rad square as one run per column:
+    # (column, first row, last row). The disk is symmetric so rows and
+    # columns can be swapped.
+    try:
+        return _diskSpans[rad]
+    except KeyError:
+        pass
+    spans = list()
+    for a in xrange(rad * 2):
+        bs = [b for b in xrange(rad * 2) if (a - rad) * (a - rad) + (b - rad) * (b - rad) <= rad * rad]
+        if bs:
+            spans.append((a, bs[0], bs[-1]))
+    _diskSpans[rad] = spans
+    return spans
+
+class SummedAreaTable(object):
+    # Sum of the values in any rectangle in constant time. The values are
+    # given column by column like TerrainGrid.cells.
+    def __init__(self, w, h, values):
+        self.h = h
+        stride = h + 1
+        sums = [0] * ((w + 1) * stride)
+        for x in xrange(w):
+            prev = x * stride + 1
+            cur = prev + stride
+            col = x * h
+            run = 0
+            for y in xrange(h):
+                run += values[col + y]
+                sums[cur + y] = sums[prev + y] + run
+        self.sums = sums
+
+    def sum(self, x0, y0, x1, y1):
+        # edges included
+        stride = self.h + 1
+        sums = self.sums
+        a = x0 * stride
+        b = (x1 + 1) * stride
+        return sums[b + y1 + 1] - sums[a + y1 + 1] - sums[b + y0] + sums[a + y0]
+
 class TerrainCreator(object):
-    def __init__(self, bf):
+    # random bytes under this give a tree, about one in six
+    treeThreshold = 43
+    # Cells only use the low seven bits. Random bytes become 0x80 for a
+    # tree and 0 otherwise, and once those are or'ed into the cells, the
+    # flagged cells that aren't water become trees.
+    treeFlags = ''.join([chr(0x80 if r < treeThreshold else 0) for r in xrange(256)])
+    plantTrees = ''.join(chr(Tile.pack(Tile.Base.Grass, Tile.Overlay.Tree)
+            if cell & 0x80 and cell & TerrainGrid.BaseMask != Tile.Base.Water else cell & 0x7f)
+            for cell in xrange(256))
+    toWater = TerrainGrid.cellTable(lambda base, overlay: (Tile.Base.Water, overlay))
+    # 1 for cells that a house can't be built on or next to, 0 otherwise
+    houseBlockers = ''.join(chr(1 if cell & TerrainGrid.BaseMask in (Tile.Base.Water, Tile.Base.Floor) else 0)
+            for cell in xrange(256))
+    houseTries = 100
+
+    def __init__(self, bf, rng=random):
         self.bf = bf
-        self.doorways = list()
-        for i in xrange(self.bf.w):
-            self.bf.terrain[i] = dict()
-            for j in xrange(self.bf.h):
-                self.bf.terrain[i][j] = Tile(Tile.Base.Grass, Tile.Overlay.NoOverlay)
+        self.rng = rng
+        self.doorways = bf.doorways
+        self.blockers = None
+        self.blockersVersion = None
+        if self.bf.terrain is None:
+            self.bf.terrain = TerrainGrid(self.bf.w, self.bf.h)
 
     def addRandomForest(self):
-        for i in xrange(self.bf.w):
-            for j in xrange(self.bf.h):
-                if self.bf.terrain[i][j].base != Tile.Base.Water:
-                    tree = i != 0 and i != self.bf.w - 1 and random.randrange(6) == 0
-                    if tree:
-                        self.bf.terrain[i][j] = Tile(Tile.Base.Grass, Tile.Overlay.Tree)
+        terrain = self.bf.terrain
+        h = self.bf.h
+        n = self.bf.w * h
+        # one random byte per cell from a single draw, and the bytes
+        # combined as big integers, so nothing is done per cell in Python
+        rnd = binascii.unhexlify('%0*x' % (2 * n, self.rng.getrandbits(8 * n)))
+        flags = int(binascii.hexlify(rnd.translate(TerrainCreator.treeFlags)), 16)
+        cells = terrain.cells
+        flagged = binascii.unhexlify('%0*x' % (2 * n, int(binascii.hexlify(cells), 16) | flags))
+        forest = bytearray(flagged.translate(TerrainCreator.plantTrees))
+        # no trees on the first and the last column
+        forest[:h] = cells[:h]
+        forest[n - h:] = cells[n - h:]
+        terrain.setCells(forest)
 
     def addCoastLine(self, width, border):
         length = self._addInitialCoast(width, border)
@@ -227,110 +1132,108 @@ class TerrainCreator(object):
 
     def _addInitialCoast(self, width, border):
         assert border >= 1 and border <= 4
+        terrain = self.bf.terrain
+        w, h = self.bf.w, self.bf.h
         if border == 1:
-            length = self.bf.h
-            for i in xrange(width):
-                for j in xrange(self.bf.h):
-                    self.bf.terrain[i][j] = Tile(Tile.Base.Water, Tile.Overlay.NoOverlay)
+            length = h
+            terrain.fillRect(0, 0, width - 1, h - 1, Tile.Base.Water, Tile.Overlay.NoOverlay)
         elif border == 2:
-            length = self.bf.w
-            for i in xrange(self.bf.w):
-                for j in xrange(self.bf.h - width, self.bf.h):
-                    self.bf.terrain[i][j] = Tile(Tile.Base.Water, Tile.Overlay.NoOverlay)
+            length = w
+            terrain.fillRect(0, h - width, w - 1, h - 1, Tile.Base.Water, Tile.Overlay.NoOverlay)
         elif border == 3:
-            length = self.bf.w
-            for i in xrange(self.bf.w):
-                for j in xrange(width):
-                    self.bf.terrain[i][j] = Tile(Tile.Base.Water, Tile.Overlay.NoOverlay)
+            length = w
+            terrain.fillRect(0, 0, w - 1, width - 1, Tile.Base.Water, Tile.Overlay.NoOverlay)
         else:
-            length = self.bf.h
-            for i in xrange(self.bf.w - width, self.bf.w):
-                for j in xrange(self.bf.h):
-                    self.bf.terrain[i][j] = Tile(Tile.Base.Water, Tile.Overlay.NoOverlay)
+            length = h
+            terrain.fillRect(w - width, 0, w - 1, h - 1, Tile.Base.Water, Tile.Overlay.NoOverlay)
         return length
 
     def _variateCoast(self, width, border, length):
+        terrain = self.bf.terrain
+        w, h = self.bf.w, self.bf.h
         for i in xrange(6, 1, -1):
             for iteration in xrange(length / 4):
-                rad = random.randrange(1, i)
-                pos = random.randrange(0, length)
-                water = random.choice([True, False])
-                for j in xrange(rad * 2):
-                    for k in xrange(rad * 2):
-                        dist = (j - rad) * (j - rad) + (k - rad) * (k - rad)
-                        if math.sqrt(dist) <= rad:
-                            if border == 1:
-                                px = width + k - rad
-                                py = pos + j - rad
-                            elif border == 2:
-                                px = pos + j - rad
-                                py = self.bf.h - (width + k - rad)
-                            elif border == 3:
-                                px = pos + j - rad
-                                py = width + k - rad
-                            else:
-                                px = self.bf.w - (width + k - rad)
-                                py = pos + j - rad
-                            if px >= 0 and py >= 0 and px < self.bf.w and py < self.bf.h:
-                                self.bf.terrain[px][py].base = Tile.Base.Water
-                                if water:
-                                    self.bf.terrain[px][py].overlay = Tile.Overlay.NoOverlay
+                rad = self.rng.randrange(1, i)
+                pos = self.rng.randrange(0, length)
+                water = self.rng.choice([True, False])
+                # stamp the disk one column slice at a time
+                for a, bmin, bmax in diskSpans(rad):
+                    if border == 1:
+                        px = width + a - rad
+                        py0, py1 = pos + bmin - rad, pos + bmax - rad
+                    elif border == 2:
+                        px = pos + a - rad
+                        py0, py1 = h - (width + bmax - rad), h - (width + bmin - rad)
+                    elif border == 3:
+                        px = pos + a - rad
+                        py0, py1 = width + bmin - rad, width + bmax - rad
+                    else:
+                        px = w - (width + a - rad)
+                        py0, py1 = pos + bmin - rad, pos + bmax - rad
+                    py0 = max(py0, 0)
+                    py1 = min(py1, h - 1)
+                    if px < 0 or px >= w or py0 > py1:
+                        continue
+                    if water:
+                        terrain.fillColumn(px, py0, py1, Tile.Base.Water, Tile.Overlay.NoOverlay)
+                    else:
+                        terrain.translateColumn(px, py0, py1, TerrainCreator.toWater)
 
     def _createInitialHouse(self):
-        hwidth = random.randrange(5, 15)
-        hheight = random.randrange(5, 15)
-        hx = random.randrange(5, self.bf.w - hwidth - 5)
-        hy = random.randrange(5, self.bf.h - hheight - 5)
+        hwidth = self.rng.randrange(5, 15)
+        hheight = self.rng.randrange(5, 15)
+        hx = self.rng.randrange(5, self.bf.w - hwidth - 5)
+        hy = self.rng.randrange(5, self.bf.h - hheight - 5)
         # now check whether the house would be in water or within another house
-        for i in xrange(hx - 3, hx + hwidth + 1 + 3):
-            for j in xrange(hy - 3, hy + hheight + 1 + 3):
-                if self.bf.terrain[i][j].base == Tile.Base.Water or self.bf.terrain[i][j].base == Tile.Base.Floor:
-                    return None
+        if self._houseBlockers().sum(hx - 3, hy - 3, hx + hwidth + 3, hy + hheight + 3):
+            return None
         return hx, hy, hwidth, hheight
 
+    def _houseBlockers(self):
+        # rebuilt only when the terrain has changed, i.e. once per house
+        # built rather than once per candidate
+        terrain = self.bf.terrain
+        if self.blockersVersion != terrain.version:
+            self.blockers = SummedAreaTable(terrain.w, terrain.h,
+                    terrain.cells.translate(TerrainCreator.houseBlockers))
+            self.blockersVersion = terrain.version
+        return self.blockers
+
     def _createHouseWalls(self, hx, hy, hwidth, hheight):
-        for i in xrange(hx, hx + hwidth + 1):
-            self.bf.terrain[i][hy] = Tile(Tile.Base.Floor, Tile.Overlay.Wall)
-        for i in xrange(hx, hx + hwidth + 1):
-            self.bf.terrain[i][hy + hheight] = Tile(Tile.Base.Floor, Tile.Overlay.Wall)
-        for i in xrange(hy, hy + hheight + 1):
-            self.bf.terrain[hx][i] = Tile(Tile.Base.Floor, Tile.Overlay.Wall)
-        for i in xrange(hy, hy + hheight + 1):
-            self.bf.terrain[hx + hwidth][i] = Tile(Tile.Base.Floor, Tile.Overlay.Wall)
+        terrain = self.bf.terrain
+        terrain.fillRect(hx, hy, hx + hwidth, hy + hheight, Tile.Base.Floor, Tile.Overlay.Wall)
 
         # create floor
-        for i in xrange(hx + 1, hx + hwidth):
-            for j in xrange(hy + 1, hy + hheight):
-                self.bf.terrain[i][j] = Tile(Tile.Base.Floor, Tile.Overlay.NoOverlay)
+        terrain.fillRect(hx + 1, hy + 1, hx + hwidth - 1, hy + hheight - 1, Tile.Base.Floor, Tile.Overlay.NoOverlay)
 
     def _createHouseDoor(self, hx, hy, hwidth, hheight):
-        dwall = random.choice(range(4))
+        dwall = self.rng.choice(range(4))
         if dwall == 0 or dwall == 1:
-            dx = hx + random.randrange(2, hwidth - 1)
+            dx = hx + self.rng.randrange(2, hwidth - 1)
             if dwall == 0:
                 dy = hy
             else:
                 dy = hy + hheight
         else:
-            dy = hy + random.randrange(2, hheight - 1)
+            dy = hy + self.rng.randrange(2, hheight - 1)
             if dwall == 2:
                 dx = hx
             else:
                 dx = hx + hwidth
-        self.bf.terrain[dx][dy] = Tile(Tile.Base.Floor, Tile.Overlay.NoOverlay)
+        self.bf.terrain.set(dx, dy, Tile.Base.Floor, Tile.Overlay.NoOverlay)
 
         # clear trees right at the door
         for i in xrange(dx - 1, dx + 2):
             for j in xrange(dy - 1, dy + 2):
-                if self.bf.terrain[i][j].overlay == Tile.Overlay.Tree:
-                    self.bf.terrain[i][j].overlay = Tile.Overlay.NoOverlay
+                if self.bf.terrain.overlay(i, j) == Tile.Overlay.Tree:
+                    self.bf.terrain.setOverlay(i, j, Tile.Overlay.NoOverlay)
 
         self.doorways.append((dx, dy))
 
     def addHouse(self):
         assert self.bf.w >= 30 and self.bf.h >= 30
         # multiple tries to ensure the house is not in water or within another house
-        for tries in xrange(10):
+        for tries in xrange(TerrainCreator.houseTries):
             houseparams = self._createInitialHouse()
             if not houseparams:
                 continue
@@ -343,28 +1246,110 @@ class TerrainCreator(object):
             self._createHouseDoor(*houseparams)
             return
 
-    def addPaths(self):
-        for i in self.doorways:
-            for j in self.doorways:
-                if i <= j:
+    def addPaths(self, ends=()):
+        # One multi-source search from all doorways splits the map into the
+        # regions closest to each doorway. Neighbouring tiles in different
+        # regions give candidate roads between the two doorways, and a
+        # minimum spanning tree over those connects all the houses. The
+        # ends are other tiles that roads lead to, as if they were doorways.
+        places = list(self.doorways) + list(ends)
+        if len(places) < 2:
+            return
+        terrain = self.bf.terrain
+        h = terrain.h
+        solver = self.bf.pathSolver
+        sources = [terrain.index(x, y) for x, y in places]
+        costs, owners, parents = solver.voronoi(terrain.cells, TerrainGrid.movementCosts,
+                self.bf.occupancy.cells, sources)
+
+        groups = range(len(sources))
+        def group(i):
+            while groups[i] != i:
+                groups[i] = groups[groups[i]]
+                i = groups[i]
+            return i
+
+        # doorways on the same tile are connected already
+        for i, source in enumerate(sources):
+            groups[i] = group(owners[source])
+
+        bridges = dict()
+        for node in xrange(len(owners)):
+            oa = owners[node]
+            if oa == -1:
+                continue
+            x, y = divmod(node, h)
+            # every pair of neighbours once
+            for dx, dy in ((0, 1), (1, -1), (1, 0), (1, 1)):
+                nx = x + dx
+                ny = y + dy
+                if nx >= terrain.w or ny < 0 or ny >= h:
+                    continue
+                other = nx * h + ny
+                ob = owners[other]
+                if ob == -1 or ob == oa:
                     continue
-                path = self.bf.getPath(i, j)
-                assert path
-                if path:
-                    for p in path:
-                        if self.bf.terrain[p[0]][p[1]].base == Tile.Base.Pathway:
-                            coords = [p]
-                        else:
-                            coords = [p, (p[0] - 1, p[1]), (p[0], p[1] - 1), (p[0] + 1, p[1]), (p[0], p[1] + 1)]
-                        for cx, cy in coords:
-                            if cx >= 0 and cy >= 0 and cx < self.bf.w and cy < self.bf.h:
-                                if self.bf.terrain[cx][cy].base == Tile.Base.Grass:
-                                    self.bf.terrain[cx][cy] = Tile(Tile.Base.Pathway, Tile.Overlay.NoOverlay)
+                cost = costs[node] + costs[other]
+                key = (oa, ob) if oa < ob else (ob, oa)
+                if key not in bridges or bridges[key][0] > cost:
+                    bridges[key] = cost, node, other
+
+        roads = list()
+        for (oa, ob), (cost, na, nb) in sorted(bridges.items(), key=lambda e: e[1][0]):
+            ga, gb = group(oa), group(ob)
+            if ga == gb:
+                continue
+            groups[ga] = gb
+            road = self._traceRoad(parents, na)
+            road.reverse()
+            road.extend(self._traceRoad(parents, nb))
+            roads.append(road)
+
+        for i, pos in enumerate(places):
+            if group(i) != group(0):
+                log.log('No road possible to %s' % (pos,))
+
+        for road in roads:
+            self._pave(road)
+        terrain.cellsChanged()
+
+    def _traceRoad(self, parents, node):
+        road = [node]
+        while parents[node] != -1:
+            node = parents[node]
+            road.append(node)
+        return road
+
+    def _pave(self, road):
+        # Turns grass along the road into pathway, widened to the four
+        # neighbours where the road isn't on pathway yet. Writes the cells
+        # directly; the caller tells the grid once all roads are done.
+        terrain = self.bf.terrain
+        cells = terrain.cells
+        w, h = terrain.w, terrain.h
+        pathway = Tile.pack(Tile.Base.Pathway, Tile.Overlay.NoOverlay)
+        for node in road:
+            if cells[node] & TerrainGrid.BaseMask == Tile.Base.Pathway:
+                coords = [node]
+            else:
+                x, y = divmod(node, h)
+                coords = [node]
+                if x > 0:
+                    coords.append(node - h)
+                if y > 0:
+                    coords.append(node - 1)
+                if x < w - 1:
+                    coords.append(node + h)
+                if y < h - 1:
+                    coords.append(node + 1)
+            for c in coords:
+                if cells[c] & TerrainGrid.BaseMask == Tile.Base.Grass:
+                    cells[c] = pathway
 
     def addWeapon(self):
         for i in xrange(self.bf.h):
-            j = random.randrange(self.bf.w)
-            if self.bf.terrain[j][i].base == Tile.Base.Grass and self.bf.terrain[j][i].overlay == Tile.Overlay.NoOverlay:
+            j = self.rng.randrange(self.bf.w)
+            if self.bf.terrain.cell(j, i) == Tile.pack(Tile.Base.Grass, Tile.Overlay.NoOverlay):
                 self.bf.addItem(Weapon(WeaponType.RifleG12), (j, i))
                 return True
         return False
@@ -374,18 +1359,18 @@ class TeamAI(object):
         Defensive = 0
         Offensive = 1
 
-    def __init__(self, bf):
+    def __init__(self, bf, rng=random):
         self.bf = bf
         self.myTeam = 1
         self.personalities = dict()
         for s in self.bf.soldiersInTeam(self.myTeam):
-            p = random.choice([TeamAI.Personality.Defensive, TeamAI.Personality.Offensive])
+            p = rng.choice([TeamAI.Personality.Defensive, TeamAI.Personality.Offensive])
             self.personalities[s] = p
 
     def coverScore(self, line):
         score = min(len(line), 10)
         for i, ((lx, ly), err) in enumerate(line):
-            ol = self.bf.terrain[lx][ly].overlay
+            ol = self.bf.terrain.overlay(lx, ly)
             if ol == Tile.Overlay.Tree:
                 if i == 0:
                     score *= 2.0
@@ -411,7 +1396,7 @@ class TeamAI(object):
         score = 10 - min(len(line), 9)
         ll = reversed(line)
         for i, ((lx, ly), err) in enumerate(ll):
-            ol = self.bf.terrain[lx][ly].overlay
+            ol = self.bf.terrain.overlay(lx, ly)
             sd = self.bf.soldierAt(lx, ly)
             if sd and sd.team == self.myTeam:
                 return 0
@@ -436,9 +1421,9 @@ class TeamAI(object):
                 px = tx
                 py = ty
                 if not abs(dy) > 2 * abs(dx):
-                    px -= math.copysign(1, dx)
+                    px -= int(math.copysign(1, dx))
                 if not abs(dx) > 2 * abs(dy):
-                    py -= math.copysign(1, dy)
+                    py -= int(math.copysign(1, dy))
                 if px >= 0 and py >= 0 and px < self.bf.w and py < self.bf.h and (mypos == px, py or self.bf.passable(px, py)):
                     positionsBehindTrees.add((px, py))
         return positionsBehindTrees
@@ -449,7 +1434,7 @@ class TeamAI(object):
         myposx, myposy = soldier.getPosition()
         for x in xrange(max(0, myposx - 5), min(self.bf.w, myposx + 5)):
             for y in xrange(max(0, myposy - 5), min(self.bf.h, myposy + 5)):
-                if self.bf.terrain[x][y].overlay == Tile.Overlay.Tree:
+                if self.bf.terrain.overlay(x, y) == Tile.Overlay.Tree:
                     nearbyTrees.append((x, y))
         positionsBehindTrees = self._getPossibleCoverPositions(nearbyTrees, soldier, enemies)
 
@@ -549,35 +1534,591 @@ class DayTime(object):
         if self.hours >= 24:
             self.hours = self.hours % 24
 
+# Bump whenever generation changes what a seed produces, so that sectors
+# cached by older versions aren't used.
+generatorVersion = 2
+
+def sectorSeed(worldSeed, loc):
+    # md5 rather than hash() so that the seed is the same on every run
+    # and platform
+    digest = hashlib.md5('%d/%d/%d' % (worldSeed, loc[0], loc[1])).hexdigest()
+    return int(digest[:16], 16)
+
+def namedRandom(seed, name):
+    # a generator of its own for each purpose, derived from seed
+    digest = hashlib.md5('%d/%s' % (seed, name)).hexdigest()
+    return random.Random(int(digest[:16], 16))
+
+def sectorBorder(loc, islandSize):
+    border = 0
+    if loc[0] == 0:
+        border |= 0x01
+    if loc[0] == islandSize[0] - 1:
+        border |= 0x08
+    if loc[1] == 0:
+        border |= 0x04
+    if loc[1] == islandSize[1] - 1:
+        border |= 0x02
+    return border
+
+def _terrainStage(bf, rng, border, coastWidth):
+    tc = TerrainCreator(bf, rng)
+    tc.addRandomForest()
+    for direction, flag in enumerate((0x01, 0x02, 0x04, 0x08)):
+        if border & flag:
+            tc.addCoastLine(coastWidth, direction + 1)
+
+class SectorChunks(object):
+    # Makes the chunks of a chunked battlefield, each like a small sector
+    # of its own: forest, coasts where the chunk is on a coast of the
+    # battlefield and a house. Each edge between two chunks has a crossing
+    # tile on either side, and the roads of a chunk connect its doorway and
+    # its crossings, so the roads of neighbouring chunks meet. Chunks and
+    # crossings have their own seeds, so a chunk comes out the same every
+    # time it's made.
+    def __init__(self, seed, border, w, h, chunkSize):
+        self.seed = seed
+        self.border = border
+        self.w = w
+        self.h = h
+        self.chunkSize = chunkSize
+
+    def __call__(self, cx, cy):
+        cs = self.chunkSize
+        border = 0
+        if cx == 0:
+            border |= self.border & 0x01
+        if cx == self.w // cs - 1:
+            border |= self.border & 0x08
+        if cy == 0:
+            border |= self.border & 0x04
+        if cy == self.h // cs - 1:
+            border |= self.border & 0x02
+        rng = namedRandom(self.seed, 'chunk/%d/%d' % (cx, cy))
+        scratch = Battlefield(cs, cs)
+        _terrainStage(scratch, rng, border, 8)
+        _housesStage(scratch, rng, 1)
+        crossings = self._crossings(cx, cy)
+        for x, y in crossings:
+            if scratch.terrain.base(x, y) != Tile.Base.Water:
+                scratch.terrain.set(x, y, Tile.Base.Pathway, Tile.Overlay.NoOverlay)
+        TerrainCreator(scratch, rng).addPaths(crossings)
+        return scratch.terrain.cells
+
+    def _crossing(self, name, cx, cy):
+        # the position along the edge on the left or top side of the chunk
+        rng = namedRandom(self.seed, 'crossing/%s/%d/%d' % (name, cx, cy))
+        return rng.randrange(2, self.chunkSize - 2)
+
+    def _crossings(self, cx, cy):
+        # the chunk's crossing tiles on the edges it shares with other chunks
+        cs = self.chunkSize
+        ret = list()
+        if cx > 0:
+            ret.append((0, self._crossing('x', cx, cy)))
+        if cx < self.w // cs - 1:
+            ret.append((cs - 1, self._crossing('x', cx + 1, cy)))
+        if cy > 0:
+            ret.append((self._crossing('y', cx, cy), 0))
+        if cy < self.h // cs - 1:
+            ret.append((self._crossing('y', cx, cy + 1), cs - 1))
+        return ret
+
+def _chunksStage(bf, rng, border, chunkSize):
+    source = SectorChunks(rng.getrandbits(64), border, bf.w, bf.h, chunkSize)
+    bf.terrain = ChunkedTerrainGrid(bf.w, bf.h, source, chunkSize)
+
+def _housesStage(bf, rng, houses):
+    tc = TerrainCreator(bf, rng)
+    for tries in xrange(houses):
+        tc.addHouse()
+
+def _pathsStage(bf, rng):
+    TerrainCreator(bf, rng).addPaths()
+
+def _itemsStage(bf, rng, weapons):
+    tc = TerrainCreator(bf, rng)
+    for i in xrange(weapons):
+        tc.addWeapon()
+
+def _enemiesStage(bf, rng):
+    bf.addEnemySoldiers(rng)
+
+class GenerationStage(object):
+    def __init__(self, name, func, **params):
+        self.name = name
+        self.func = func
+        self.params = params
+
+    def run(self, bf, rng):
+        self.func(bf, rng, **self.params)
+
+    def describe(self):
+        return '%s(%s)' % (self.name, ', '.join('%s=%r' % p for p in sorted(self.params.items())))
+
+class SectorGenerator(object):
+    # Generates a sector as a pipeline of named stages. Each stage draws
+    # from its own generator seeded by the sector and stage name, so
+    # changing one stage doesn't shift the random numbers of the others.
+    # With a cache directory the battlefield is saved after every stage,
+    # keyed by a hash of the seed and all stages up to that one, and
+    # generation resumes from the latest stage found in the cache.
+    # sectors larger than this are made of chunks generated on demand
+    maxFlatArea = 256 * 256
+
+    def __init__(self, worldSeed, loc, islandSize, startSector, cacheDir=None, sectorSize=None):
+        self.seed = sectorSeed(worldSeed, loc)
+        self.loc = loc
+        self.cacheDir = cacheDir
+        self.w, self.h = sectorSize or Battlefield.defaultSize
+        self.chunked = self.w * self.h > SectorGenerator.maxFlatArea
+        border = sectorBorder(loc, islandSize)
+        if self.chunked:
+            self.stages = [GenerationStage('chunks', _chunksStage,
+                                border=border, chunkSize=ChunkedTerrainGrid.defaultChunkSize)]
+        else:
+            self.stages = [GenerationStage('terrain', _terrainStage, border=border, coastWidth=8),
+                           GenerationStage('houses', _housesStage, houses=3),
+                           GenerationStage('paths', _pathsStage)]
+        self.stages.append(GenerationStage('items', _itemsStage, weapons=1))
+        if loc != startSector:
+            self.stages.append(GenerationStage('enemies', _enemiesStage))
+
+    def stageKeys(self):
+        keys = list()
+        key = '%d/%d/%dx%d' % (generatorVersion, self.seed, self.w, self.h)
+        for stage in self.stages:
+            key = hashlib.md5('%s/%s' % (key, stage.describe())).hexdigest()
+            keys.append(key)
+        return keys
+
+    def stageRandom(self, stage):
+        return namedRandom(self.seed, stage.name)
+
+    def cachePath(self, key):
+        return os.path.join(self.cacheDir, key + '.stage')
+
+    def cached(self, key):
+        return self.cacheDir is not None and os.path.exists(self.cachePath(key))
+
+    def _load(self, key):
+        try:
+            with open(self.cachePath(key), 'rb') as f:
+                return pickle.load(f)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def _save(self, key, bf):
+        # written under a temporary name first so that other processes
+        # never see a half-written file
+        if not os.path.isdir(self.cacheDir):
+            try:
+                os.makedirs(self.cacheDir)
+            except OSError:
+                # another worker may have just created it
+                if not os.path.isdir(self.cacheDir):
+                    raise
+        path = self.cachePath(key)
+        tmppath = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmppath, 'wb') as f:
+            pickle.dump(bf, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmppath, path)
+
+    def generate(self):
+        keys = self.stageKeys()
+        bf = None
+        first = 0
+        if self.cacheDir is not None:
+            for i in reversed(xrange(len(keys))):
+                if self.cached(keys[i]):
+                    bf = self._load(keys[i])
+                    if bf is not None:
+                        first = i + 1
+                        break
+        if bf is None:
+            bf = Battlefield(self.w, self.h, self.chunked)
+        for i in xrange(first, len(self.stages)):
+            stage = self.stages[i]
+            stage.run(bf, self.stageRandom(stage))
+            if self.cacheDir is not None:
+                self._save(keys[i], bf)
+        return bf
+
+class SectorCache(object):
+    # Generated sectors of one world on disk. Each sector is appended to
+    # the data file as its terrain cells followed by the rest of the
+    # battlefield pickled, and a fixed size record of where it went is
+    # appended to the index file, so storing a sector never rewrites what
+    # is there already. The data file is memory mapped for reading, so
+    # loading a sector copies just its slice. Sectors stored again leave
+    # their old data behind, which is dropped by compacting the files once
+    # it takes more space than the live sectors. Games sharing the cache
+    # take turns through a lock file, and each reads the index again when
+    # another has changed it.
+    # record: loc x, loc y, offset, w, h, length of cells, length of pickle
+    recordFormat = '<iiQiiII'
+    recordSize = struct.calcsize(recordFormat)
+
+    def __init__(self, cacheDir, seed, islandSize, sectorSize):
+        self.cacheDir = cacheDir
+        name = 'world-%d-%dx%d-%dx%d-v%d' % (seed, islandSize[0], islandSize[1],
+                sectorSize[0], sectorSize[1], generatorVersion)
+        self.dataPath = os.path.join(cacheDir, name + '.data')
+        self.indexPath = os.path.join(cacheDir, name + '.index')
+        self.lockPath = os.path.join(cacheDir, name + '.lock')
+        # loc -> (offset, w, h, length of cells, length of pickle)
+        self.index = None
+        # inode and size of the index file the index was read from
+        self.indexStat = None
+        self.live = 0
+        self.garbage = 0
+        self.dataMap = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['index'] = None
+        state['indexStat'] = None
+        state['dataMap'] = None
+        return state
+
+    @contextlib.contextmanager
+    def _locked(self):
+        if not os.path.isdir(self.cacheDir):
+            os.makedirs(self.cacheDir)
+        with open(self.lockPath, 'a') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                self._loadIndex()
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def _statIndex(self):
+        try:
+            st = os.stat(self.indexPath)
+        except OSError:
+            return None
+        return st.st_ino, st.st_size
+
+    def _loadIndex(self):
+        # called with the lock held
+        stat = self._statIndex()
+        if self.index is not None and stat == self.indexStat:
+            return self.index
+        self._unmap()
+        self.index = dict()
+        self.live = 0
+        self.garbage = 0
+        try:
+            with open(self.indexPath, 'rb') as f:
+                records = f.read()
+        except IOError:
+            records = ''
+        # A crash while storing can leave part of a record at the end of
+        # the index, or data no record points to at the end of the data
+        # file. Both are cut off.
+        size = SectorCache.recordSize
+        good = len(records) - len(records) % size
+        end = 0
+        for i in xrange(0, good, size):
+            record = struct.unpack_from(SectorCache.recordFormat, records, i)
+            self._addRecord(tuple(record[:2]), record[2:])
+            end = max(end, record[2] + record[5] + record[6])
+        if good != len(records):
+            self._truncate(self.indexPath, good)
+        self._truncate(self.dataPath, end)
+        self.indexStat = self._statIndex()
+        return self.index
+
+    def _addRecord(self, loc, record):
+        old = self.index.get(loc)
+        if old is not None:
+            self.live -= old[3] + old[4]
+            self.garbage += old[3] + old[4]
+        self.index[loc] = record
+        self.live += record[3] + record[4]
+
+    def _truncate(self, path, size):
+        try:
+            if os.path.getsize(path) > size:
+                with open(path, 'r+b') as f:
+                    f.truncate(size)
+        except OSError:
+            pass
+
+    def _map(self):
+        if self.dataMap is None:
+            with open(self.dataPath, 'rb') as f:
+                self.dataMap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.dataMap
+
+    def _unmap(self):
+        # the file changed, so map it again on next load
+        if self.dataMap is not None:
+            self.dataMap.close()
+            self.dataMap = None
+
+    def __contains__(self, loc):
+        with self._locked():
+            return loc in self.index
+
+    def load(self, loc):
+        # raises KeyError if the sector isn't cached
+        with self._locked():
+            offset, w, h, cellsLength, dataLength = self.index[loc]
+            start = offset + cellsLength
+            try:
+                if os.path.getsize(self.dataPath) < start + dataLength:
+                    raise KeyError(loc)
+                data = self._map()
+            except (OSError, IOError, ValueError):
+                raise KeyError(loc)
+            if len(data) < start + dataLength:
+                raise KeyError(loc)
+            pickled = data[start:start + dataLength]
+            cells = data[offset:start]
+        bf = pickle.loads(pickled)
+        if cellsLength:
+            bf.terrain = TerrainGrid(w, h)
+            bf.terrain.setCells(cells)
+        return bf
+
+    def store(self, loc, bf):
+        terrain = bf.terrain
+        if terrain.chunked:
+            # chunks are made on demand anyway, so there's no terrain to
+            # store but the edited chunks, which are pickled with the rest
+            cells = ''
+            data = pickle.dumps(bf, pickle.HIGHEST_PROTOCOL)
+        else:
+            cells = terrain.cells
+            bf.terrain = None
+            try:
+                data = pickle.dumps(bf, pickle.HIGHEST_PROTOCOL)
+            finally:
+                bf.terrain = terrain
+        with self._locked():
+            self._unmap()
+            with open(self.dataPath, 'ab') as f:
+                f.seek(0, os.SEEK_END)
+                offset = f.tell()
+                f.write(cells)
+                f.write(data)
+            record = offset, terrain.w, terrain.h, len(cells), len(data)
+            with open(self.indexPath, 'ab') as f:
+                f.write(struct.pack(SectorCache.recordFormat, loc[0], loc[1], *record))
+            self._addRecord(loc, record)
+            self.indexStat = self._statIndex()
+            if self.garbage > self.live:
+                self._compact()
+
+    def compact(self):
+        with self._locked():
+            self._compact()
+
+    def _compact(self):
+        # Writes the live sectors to new files. The old index goes first,
+        # so a crash halfway leaves an empty cache rather than an index
+        # pointing into the wrong data file.
+        index = self.index
+        if not index:
+            return
+        data = self._map()
+        dataTmp = '%s.%d.tmp' % (self.dataPath, os.getpid())
+        indexTmp = '%s.%d.tmp' % (self.indexPath, os.getpid())
+        newIndex = dict()
+        with open(dataTmp, 'wb') as df:
+            with open(indexTmp, 'wb') as xf:
+                for loc, (offset, w, h, cellsLength, dataLength) in sorted(index.items()):
+                    record = df.tell(), w, h, cellsLength, dataLength
+                    df.write(data[offset:offset + cellsLength + dataLength])
+                    xf.write(struct.pack(SectorCache.recordFormat, loc[0], loc[1], *record))
+                    newIndex[loc] = record
+        self._unmap()
+        os.remove(self.indexPath)
+        os.rename(dataTmp, self.dataPath)
+        os.rename(indexTmp, self.indexPath)
+        self.index = newIndex
+        self.indexStat = self._statIndex()
+        self.garbage = 0
+
+class SectorStore(object):
+    # The sectors of an island by location. Sectors stay in memory while
+    # their estimated size fits in memoryBudget bytes; beyond that the
+    # least recently used ones are pickled to spillDir with all their
+    # state and loaded back when they're needed again. The pinned sector
+    # and the one used last are never spilled.
+    defaultMemoryBudget = 256 * 1024 * 1024
+
+    def __init__(self, memoryBudget=defaultMemoryBudget, spillDir=None):
+        self.memoryBudget = memoryBudget
+        self.spillDir = spillDir
+        self.ownSpillDir = False
+        self.resident = collections.OrderedDict()
+        self.spilled = set()
+        self.pinned = None
+        self.loads = 0
+        self.evictions = 0
+
+    def __getstate__(self):
+        # the spilled sectors go into the pickle as they are on disk
+        state = self.__dict__.copy()
+        state['spilled'] = dict((loc, self._readSpilled(loc)) for loc in self.spilled)
+        if self.ownSpillDir:
+            state['spillDir'] = None
+            state['ownSpillDir'] = False
+        return state
+
+    def __setstate__(self, state):
+        spilled = state.pop('spilled')
+        self.__dict__.update(state)
+        self.spilled = set()
+        for loc, data in spilled.items():
+            self._writeSpilled(loc, data)
+            self.spilled.add(loc)
+
+    def __contains__(self, loc):
+        return loc in self.resident or loc in self.spilled
+
+    def __len__(self):
+        return len(self.resident) + len(self.spilled)
+
+    def __iter__(self):
+        return iter(list(self.resident) + list(self.spilled))
+
+    def __getitem__(self, loc):
+        return self.get(loc)
+
+    def get(self, loc):
+        # raises KeyError for sectors that were never stored
+        try:
+            bf = self.resident.pop(loc)
+        except KeyError:
+            if loc not in self.spilled:
+                raise
+            bf = pickle.loads(self._readSpilled(loc))
+            os.remove(self._spillPath(loc))
+            self.spilled.remove(loc)
+            self.loads += 1
+        self.resident[loc] = bf
+        self._evict()
+        return bf
+
+    def put(self, loc, bf):
+        self.resident.pop(loc, None)
+        self.spilled.discard(loc)
+        self.resident[loc] = bf
+        self._evict()
+
+    def pin(self, loc):
+        self.pinned = loc
+
+    def _evict(self):
+        # sizes change as chunked sectors are explored, so they're
+        # estimated again each time
+        used = sum(bf.memoryUse() for bf in self.resident.itervalues())
+        if used <= self.memoryBudget:
+            return
+        last = next(reversed(self.resident))
+        for loc in list(self.resident):
+            if used <= self.memoryBudget:
+                break
+            if loc == self.pinned or loc == last:
+                continue
+            bf = self.resident.pop(loc)
+            used -= bf.memoryUse()
+            # nobody is playing this sector while it's on disk
+            bf.currentSoldier = None
+            self._writeSpilled(loc, pickle.dumps(bf, pickle.HIGHEST_PROTOCOL))
+            self.spilled.add(loc)
+            self.evictions += 1
+            log.log('Spilled sector %s (%d loads, %d evictions)' % (loc, self.loads, self.evictions))
+
+    def _spillPath(self, loc):
+        if self.spillDir is None:
+            self.spillDir = tempfile.mkdtemp(prefix='thunder-islands-')
+            self.ownSpillDir = True
+            atexit.register(shutil.rmtree, self.spillDir, True)
+        elif not os.path.isdir(self.spillDir):
+            os.makedirs(self.spillDir)
+        return os.path.join(self.spillDir, 'sector-%d-%d' % loc)
+
+    def _readSpilled(self, loc):
+        with open(self._spillPath(loc), 'rb') as f:
+            return f.read()
+
+    def _writeSpilled(self, loc, data):
+        with open(self._spillPath(loc), 'wb') as f:
+            f.write(data)
+
+def generateSector(worldSeed, loc, islandSize, startSector, cacheDir=None, sectorSize=None):
+    # Everything random in a sector comes from its own generators, so a
+    # sector looks the same no matter when or in which order it's created.
+    return SectorGenerator(worldSeed, loc, islandSize, startSector, cacheDir, sectorSize).generate()
+
+def _generateSectorData(args):
+    # Runs in a pool worker. The battlefield is pickled here so that what
+    # crosses the process boundary is one compact string without caches.
+    worldSeed, loc, islandSize, startSector, cacheDir, sectorSize = args
+    bf = generateSector(worldSeed, loc, islandSize, startSector, cacheDir, sectorSize)
+    return loc, pickle.dumps(bf, pickle.HIGHEST_PROTOCOL)
+
+def parseIslandSize(s):
+    # 'WxH' in sectors
+    w, h = [int(n) for n in s.split('x')]
+    if w < 1 or h < 1:
+        raise ValueError('island must be at least 1x1')
+    return w, h
+
+def parseSectorSize(s):
+    # 'WxH' in tiles; room for houses, and whole chunks if it's chunked
+    w, h = [int(n) for n in s.split('x')]
+    if w < 40 or h < 40:
+        raise ValueError('sectors must be at least 40x40')
+    cs = ChunkedTerrainGrid.defaultChunkSize
+    if w * h > SectorGenerator.maxFlatArea and (w % cs or h % cs):
+        raise ValueError('large sectors must be multiples of %d on each side' % cs)
+    return w, h
+
 class Island(object):
-    def __init__(self, seed=None):
+    defaultSize = 3, 4
+
+    @staticmethod
+    def startSectorFor(islandSize):
+        # the south-east corner
+        return islandSize[0] - 1, islandSize[1] - 1
+
+    def __init__(self, seed=None, workers=0, cacheDir=None, sectorCacheDir=None,
+            islandSize=None, memoryBudget=SectorStore.defaultMemoryBudget, spillDir=None,
+            sectorSize=None):
         if seed is None:
             seed = int(time.time())
         random.seed(seed)
         log.log('Random seed: %d' % seed)
 
-        self.sectors = dict()
-        self.currSector = 2, 3
-        self.islandSize = 3, 4
+        self.seed = seed
+        self.islandSize = islandSize or Island.defaultSize
+        self.startSector = Island.startSectorFor(self.islandSize)
+        self.sectorSize = sectorSize or Battlefield.defaultSize
+        self.cacheDir = cacheDir
+        if sectorCacheDir:
+            self.sectorCache = SectorCache(sectorCacheDir, seed, self.islandSize, self.sectorSize)
+        else:
+            self.sectorCache = None
+        self.sectors = SectorStore(memoryBudget, spillDir)
+        # held while a sector is generated, loaded or prepared, so that the
+        # prefetch thread and the game never work on the same sector
+        self.sectorLock = threading.RLock()
+        self.prefetchQueue = None
+        self.prefetchThread = None
+        self.prefetchPool = None
+        self.prefetched = set()
+        # the sector and travel bands that sectors were last prefetched for
+        self.prefetchedFor = None
+        self.currSector = self.startSector
         self.bf = None
         self.time = DayTime()
 
-        for i in xrange(3):
-            self.sectors[i] = dict()
-            for j in xrange(4):
-                border = 0
-                if i == 0:
-                    border |= 0x01
-                if i == 2:
-                    border |= 0x08
-                if j == 0:
-                    border |= 0x04
-                if j == 3:
-                    border |= 0x02
-                self.sectors[i][j] = Battlefield(border)
-                if i != self.currSector[0] or j != self.currSector[1]:
-                    self.sectors[i][j].addEnemySoldiers()
-
         self.playerSoldiers = list()
 
         names = soldierNames()
@@ -590,13 +2131,181 @@ class Island(object):
                 s.addToInventory(Clip(bt))
             self.playerSoldiers.append(s)
 
+        if workers:
+            self.generateAll(workers)
         self.placeSoldiers(0)
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['sectorLock']
+        state['prefetchQueue'] = None
+        state['prefetchThread'] = None
+        state['prefetchPool'] = None
+        state['prefetched'] = set()
+        state['prefetchedFor'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.sectorLock = threading.RLock()
+
+    def save(self, f):
+        # not while the prefetch thread is halfway through a sector
+        with self.sectorLock:
+            pickle.dump(self, f)
+
     def getCurrentBattlefield(self):
         return self.bf
 
+    def getCurrentTeamAI(self):
+        return self.teamAI(self.currSector)
+
+    def getSector(self, loc):
+        with self.sectorLock:
+            try:
+                return self.sectors[loc]
+            except KeyError:
+                pass
+            if self.sectorCache is not None:
+                try:
+                    bf = self.sectorCache.load(loc)
+                except KeyError:
+                    pass
+                else:
+                    self.sectors.put(loc, bf)
+                    return bf
+            bf = generateSector(self.seed, loc, self.islandSize, self.startSector, self.cacheDir,
+                    self.sectorSize)
+            self._addGenerated(loc, bf)
+            return bf
+
+    def _addGenerated(self, loc, bf):
+        # cached before the player's soldiers are placed in it
+        with self.sectorLock:
+            if self.sectorCache is not None:
+                self.sectorCache.store(loc, bf)
+            self.sectors.put(loc, bf)
+
+    def teamAI(self, loc):
+        # Personalities come from the sector's own seed, so it doesn't matter
+        # whether the AI was made in the background or on entry. The AI is
+        # kept on the battlefield so that it's spilled along with it.
+        with self.sectorLock:
+            bf = self.getSector(loc)
+            if bf.ai is None:
+                bf.ai = TeamAI(bf, namedRandom(sectorSeed(self.seed, loc), 'ai'))
+            return bf.ai
+
+    def prefetchNeighbours(self):
+        # Prepares the sectors next to the edges that the player's soldiers
+        # are close to in a background thread, so that travelling there
+        # doesn't have to wait for generation. Cheap unless the player's
+        # sector or the travel bands the soldiers are in have changed.
+        # Sectors spilled since they were prepared need preparing again.
+        bands = tuple(self.bf.nearEdge(direction) for direction in xrange(1, 5))
+        key = self.currSector, bands
+        if key == self.prefetchedFor:
+            return
+        self.prefetchedFor = key
+        with self.sectorLock:
+            self.prefetched -= self.sectors.spilled
+        for direction in xrange(1, 5):
+            loc = self._newLocation(direction)
+            if loc is not None and loc not in self.prefetched and bands[direction - 1]:
+                self.prefetch(loc)
+
+    def prefetch(self, loc):
+        self.prefetched.add(loc)
+        if self.prefetchQueue is None:
+            # made before the thread, so the worker isn't forked while the
+            # thread holds a lock
+            self.prefetchPool = multiprocessing.Pool(1)
+            self.prefetchQueue = Queue.Queue()
+            self.prefetchThread = threading.Thread(target=self._prefetchLoop, args=(self.prefetchQueue,))
+            self.prefetchThread.daemon = True
+            self.prefetchThread.start()
+        self.prefetchQueue.put(loc)
+
+    def stopPrefetching(self):
+        # waits for the sector being prepared, if any
+        if self.prefetchQueue is not None:
+            self.prefetchQueue.put(None)
+            self.prefetchThread.join()
+            self.prefetchPool.close()
+            self.prefetchPool.join()
+            self.prefetchQueue = None
+            self.prefetchPool = None
+            self.prefetched = set()
+            self.prefetchedFor = None
+
+    def _prefetchLoop(self, queue):
+        while True:
+            loc = queue.get()
+            if loc is None:
+                return
+            try:
+                self._prepare(loc)
+            except Exception:
+                log.log('Prefetching sector %s failed:\n%s' % (loc, traceback.format_exc()))
+
+    def _prepare(self, loc):
+        t = time.time()
+        with self.sectorLock:
+            # the game owns the current sector
+            if loc == self.currSector:
+                return
+            generate = loc not in self.sectors and (self.sectorCache is None or
+                    loc not in self.sectorCache)
+        if generate:
+            # Generation is most of the work, and runs in the pool so that
+            # it doesn't compete with the game for the interpreter. The
+            # game may have made the sector itself in the meantime.
+            job = self.seed, loc, self.islandSize, self.startSector, self.cacheDir, self.sectorSize
+            bf = pickle.loads(self.prefetchPool.apply(_generateSectorData, (job,))[1])
+            with self.sectorLock:
+                if loc not in self.sectors:
+                    self._addGenerated(loc, bf)
+        with self.sectorLock:
+            if loc == self.currSector:
+                return
+            bf = self.getSector(loc)
+            self.teamAI(loc)
+            if bf.terrain.components is not None:
+                bf.terrain.components.label(0)
+            bf.teamVisibility(1).sync()
+        log.log('Prefetched sector %s in %.3fs' % (loc, time.time() - t))
+
+    def generateAll(self, workers=1):
+        locs = [(i, j) for i in xrange(self.islandSize[0]) for j in xrange(self.islandSize[1])
+                if (i, j) not in self.sectors]
+        if self.sectorCache is not None:
+            for loc in locs:
+                if loc in self.sectorCache:
+                    self.getSector(loc)
+            locs = [loc for loc in locs if loc not in self.sectors]
+        jobs = [(self.seed, loc, self.islandSize, self.startSector, self.cacheDir, self.sectorSize)
+                for loc in locs]
+        t = time.time()
+        if workers > 1 and len(jobs) > 1:
+            pool = multiprocessing.Pool(workers)
+            try:
+                # map keeps the job order, and each sector only depends on
+                # its own seed, so the result doesn't depend on scheduling
+                results = pool.map(_generateSectorData, jobs)
+            finally:
+                pool.close()
+                pool.join()
+            for loc, data in results:
+                self._addGenerated(loc, pickle.loads(data))
+        else:
+            for loc in locs:
+                self.getSector(loc)
+        log.log('Generated %d sectors with %d workers in %.2fs' % (len(locs), workers, time.time() - t))
+
     def placeSoldiers(self, direction):
-        self.bf = self.sectors[self.currSector[0]][self.currSector[1]]
+        with self.sectorLock:
+            self.sectors.pin(self.currSector)
+            self.bf = self.getSector(self.currSector)
 
         for i, s in enumerate(self.playerSoldiers):
             x = self.bf.w / 2
@@ -618,12 +2327,10 @@ class Island(object):
                     break
                 x += xd
                 y += yd
-            s.x = x
-            s.y = y
+            s.setPosition((x, y))
+            self.bf.addSoldier(s)
 
         self.bf.setCurrentSoldier(self.playerSoldiers[0])
-        for s in self.playerSoldiers:
-            self.bf.soldiers.append(s)
 
     def _newLocation(self, direction):
         assert direction >= 1 and direction <= 4
@@ -648,6 +2355,9 @@ class Island(object):
         if nloc is None:
             return False
 
+        cache = self.bf.pathCache
+        log.log('Leaving sector %s (path cache: %d hits, %d misses, %.0f%% hit rate)' %
+                (self.currSector, cache.hits, cache.misses, 100 * cache.hitRate()))
         self.bf.removeSoldiersFromTeam(0)
         self.currSector = nloc
         self.placeSoldiers(direction)
@@ -658,31 +2368,72 @@ class Island(object):
         self.time.progress(0, 5, 0)
 
 class Battlefield(object):
-    def __init__(self, border):
-        self.w = 80
-        self.h = 40
+    # every tile in between costs at least 0.05 visibility, so nothing
+    # further than this can be seen
+    sightRange = 20
+    # how close to an edge soldiers need to be to leave an enemy sector
+    travelBand = 5
+
+    defaultSize = 80, 40
+    # how far around the two ends a path search on chunked terrain looks
+    # first, and at most; chunked terrain has no component labels, so a
+    # goal that can't be reached is only given up on at the largest margin
+    searchMargin = 32
+    maxSearchMargin = 128
+
+    def __init__(self, w=defaultSize[0], h=defaultSize[1], chunked=False):
+        self.w = w
+        self.h = h
         self.soldiers = list()
-        self.terrain = dict()
+        # nothing the size of the whole battlefield if it's chunked
+        if chunked:
+            self.occupancy = SparseOccupancyGrid(self.w, self.h)
+            self.pathSolver = None
+        else:
+            self.occupancy = OccupancyGrid(self.w, self.h)
+            self.pathSolver = astar.GridSolver(self.w, self.h)
+        self.windowSolver = None
+        self.soldierIndex = SpatialIndex()
+        self.itemIndex = SpatialIndex()
+        self.reachMaps = dict()
+        self.pathCache = PathCache()
+        self.fieldsOfView = dict()
+        self.teamVisibilities = dict()
+        self.terrain = None
+        self.doorways = list()
+        self.ai = None
         self.listeners = list()
         self.moveTarget = None
         self.shootLine = None
         self.shotDistance = None
         self.currentSoldier = None
         self.friendly = True
+        # what may look different since the view last asked, see takeDirty()
+        self.dirtyCells = set()
+        self.dirtyPanels = set()
 
         self.items = collections.defaultdict(list)
 
-        self.createTerrain(border)
-
-        for s in self.soldiers:
-            s.refreshAPs()
-
-    def addEnemySoldiers(self):
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['reachMaps'] = dict()
+        state['pathCache'] = PathCache(self.pathCache.size)
+        state['fieldsOfView'] = dict()
+        state['teamVisibilities'] = dict()
+        state['windowSolver'] = None
+        # listeners are parts of the view, which adds new ones for itself
+        state['listeners'] = list()
+        # and a new view draws everything anyway
+        state['dirtyCells'] = set()
+        state['dirtyPanels'] = set()
+        return state
+
+    def addEnemySoldiers(self, rng=random):
         self.friendly = False
         for i in xrange(4):
             for j in xrange(5):
-                x = random.randrange(30, self.w)
-                y = random.randrange(20, self.h)
+                x = rng.randrange(30, self.w)
+                y = rng.randrange(20, self.h)
                 if self.passable(x, y):
                     break
 
@@ -692,80 +2443,242 @@ class Battlefield(object):
             else:
                 wp = WeaponType.RifleG12
                 bt = BulletType.Gauge12
-            s = Soldier(x, y, 1, getSoldierAttributes(True, None))
+            s = Soldier(x, y, 1, getSoldierAttributes(True, None, rng))
             if i == 0:
                 self.setCurrentSoldier(s)
             s.addToInventory(Weapon(wp))
             for j in xrange(3):
                 s.addToInventory(Clip(bt))
-            self.soldiers.append(s)
+            self.addSoldier(s)
+
+    def addSoldier(self, soldier):
+        # a soldier placed where it can't stand goes to the nearest tile
+        # where it can
+        if soldier.alive() and not self.passable(soldier.x, soldier.y):
+            pos = self.freeTileNear(soldier.getPosition())
+            assert pos is not None, 'no room for another soldier'
+            soldier.setPosition(pos)
+        soldier.battlefield = self
+        self.soldiers.append(soldier)
+        if soldier.alive():
+            self.occupancy.add(soldier)
+            self.soldierIndex.add(soldier, soldier.getPosition())
+        self._soldierChanged(soldier)
+        self._markAround(soldier.getPosition())
+        self.dirtyPanels.add(soldier)
+
+    def freeTileNear(self, pos):
+        # the nearest tile to pos a soldier can stand on, or None
+        x, y = pos
+        for r in xrange(max(self.w, self.h)):
+            for nx in xrange(max(0, x - r), min(self.w, x + r + 1)):
+                for ny in xrange(max(0, y - r), min(self.h, y + r + 1)):
+                    if max(abs(nx - x), abs(ny - y)) == r and self.passable(nx, ny):
+                        return nx, ny
+        return None
 
     def removeSoldiersFromTeam(self, teamnum):
+        if self.currentSoldier is not None and self.currentSoldier.team == teamnum:
+            self.setCurrentSoldier(None)
+        for s in self.soldiers:
+            if s.team == teamnum:
+                self.occupancy.remove(s)
+                self.soldierIndex.remove(s)
+                s.battlefield = None
+                self._soldierChanged(s)
+                self._markAround(s.getPosition())
+                self.dirtyPanels.add(s)
         self.soldiers = [s for s in self.soldiers if s.team != teamnum]
 
-    def createTerrain(self, border):
-        tc = TerrainCreator(self)
-        tc.addRandomForest()
-        if border & 0x01:
-            tc.addCoastLine(8, 1)
-        if border & 0x02:
-            tc.addCoastLine(8, 2)
-        if border & 0x04:
-            tc.addCoastLine(8, 3)
-        if border & 0x08:
-            tc.addCoastLine(8, 4)
-        for tries in xrange(3):
-            tc.addHouse()
-        tc.addPaths()
-        tc.addWeapon()
+    def soldierMoved(self, soldier, oldpos):
+        if soldier.alive():
+            self.occupancy.move(soldier, oldpos)
+            self.soldierIndex.move(soldier, soldier.getPosition())
+        self._soldierChanged(soldier)
+        self._markAround(oldpos)
+        self._markAround(soldier.getPosition())
+
+    def soldierDied(self, soldier):
+        self.occupancy.remove(soldier)
+        self.soldierIndex.remove(soldier)
+        self._soldierChanged(soldier)
+        self._markAround(soldier.getPosition())
+
+    def soldierStatsChanged(self, soldier):
+        self.dirtyPanels.add(soldier)
+
+    def _soldierChanged(self, soldier):
+        for tv in self.teamVisibilities.values():
+            tv.soldierChanged(soldier)
+
+    def _markAround(self, pos):
+        # the tile changed, and the soldiers and items near it may have come
+        # into or gone out of someone's sight
+        dirty = self.dirtyCells
+        dirty.add(pos)
+        for s in self.soldierIndex.near(pos, Battlefield.sightRange):
+            dirty.add(s.getPosition())
+        dirty.update(self.itemIndex.near(pos, Battlefield.sightRange))
+
+    def _markSoldier(self, soldier):
+        if soldier:
+            self.dirtyCells.add(soldier.getPosition())
+            self.dirtyPanels.add(soldier)
+
+    def takeDirty(self):
+        # The tiles and soldiers whose display may have changed since the
+        # last call. Changes to the terrain itself are only told by its
+        # version.
+        cells, panels = self.dirtyCells, self.dirtyPanels
+        self.dirtyCells = set()
+        self.dirtyPanels = set()
+        return cells, panels
+
+    def teamVisibility(self, teamnum):
+        try:
+            return self.teamVisibilities[teamnum]
+        except KeyError:
+            tv = TeamVisibility(self, teamnum)
+            self.teamVisibilities[teamnum] = tv
+            return tv
 
     def addListener(self, listener):
         self.listeners.append(listener)
 
+    def removeListener(self, listener):
+        self.listeners.remove(listener)
+
     def soldierAt(self, x, y):
-        for s in self.soldiers:
-            if s.x == x and s.y == y and s.alive():
-                return s
-        return None
+        return self.occupancy.soldierAt(x, y)
+
+    def soldiersIn(self, area):
+        # alive soldiers within (x0, y0, x1, y1)
+        return self.soldierIndex.inArea(*area)
 
     def getCurrentSoldier(self):
         return self.currentSoldier
 
     def setCurrentSoldier(self, soldier):
+        self._markSoldier(self.currentSoldier)
         self.currentSoldier = soldier
+        self._markSoldier(soldier)
 
     def getPath(self, start, end):
-        if not self.passable(end[0], end[1]):
+        path = self.getPathWithCosts(start, end)
+        if path is None:
             return None
+        return [p for p, cost in path]
 
-        def neighbours(v):
-            ret = list()
-            for i, j in [(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)]:
-                nx = v[0] + i
-                ny = v[1] + j
-                if nx < 0 or ny < 0 or nx >= self.w or ny >= self.h:
-                    continue
-                if self.passable(nx, ny):
-                    ret.append((nx, ny))
-            return ret
+    def getPathWithCosts(self, start, end):
+        key = start, end, self.terrain.version, self.occupancy.version
+        try:
+            path = self.pathCache.get(key)
+        except KeyError:
+            path = self._solvePath(start, end)
+            self.pathCache.put(key, path)
+        if path is None:
+            return None
+        return list(path)
 
-        def costfunc(n1, n2):
-            return self.movementCost(n2[0], n2[1])
+    def _solvePath(self, start, end):
+        if not self.passable(end[0], end[1]):
+            return None
+        # cheap checks before the search: walled off by terrain, or all
+        # approaches to the goal taken by soldiers
+        if self.terrain.passable(start[0], start[1]) and not self.terrain.connected(start, end):
+            return None
+        if self._enclosed(end, start):
+            return None
 
-        path = astar.solve(neighbours, costfunc, astar.euclidHeuristics(end),
-                astar.makeGoalFunc(end), start)
-        return path
+        # the search only covers the area around start and end, widened
+        # until there's a path, it covers the whole battlefield or it's as
+        # wide as it gets
+        margin = Battlefield.searchMargin
+        while True:
+            grid, blocked, solver, ox, oy = self.searchArea(min(start[0], end[0]) - margin,
+                    min(start[1], end[1]) - margin, max(start[0], end[0]) + margin,
+                    max(start[1], end[1]) + margin)
+            path = solver.solve(grid.cells, TerrainGrid.movementCosts, blocked,
+                    grid.index(start[0] - ox, start[1] - oy), grid.index(end[0] - ox, end[1] - oy))
+            if path is not None:
+                break
+            if grid.w == self.w and grid.h == self.h or margin >= Battlefield.maxSearchMargin:
+                return None
+            margin *= 2
+        ret = list()
+        for n in path:
+            x, y = grid.coord(n)
+            ret.append(((x + ox, y + oy), solver.costTo(n)))
+        return tuple(ret)
+
+    def searchArea(self, x0, y0, x1, y1):
+        # Terrain cells, blocked tiles and a solver covering at least the
+        # area, and the position of their node 0. Flat terrain is searched
+        # as a whole, chunked terrain through a copy of the area.
+        grid, ox, oy = self.terrain.window(x0, y0, x1, y1)
+        if grid is self.terrain:
+            return grid, self.occupancy.cells, self.pathSolver, 0, 0
+        solver = self.windowSolver
+        if solver is None:
+            solver = astar.GridSolver(grid.w, grid.h)
+            self.windowSolver = solver
+        else:
+            solver.reshape(grid.w, grid.h)
+        return grid, self.occupancy.window(ox, oy, grid.w, grid.h), solver, ox, oy
+
+    def memoryUse(self):
+        # a rough estimate in bytes: the terrain, and per tile the
+        # occupancy, component labels and path solver arrays of flat
+        # battlefields
+        terrain = self.terrain
+        if terrain.chunked:
+            ret = len(terrain.chunks) * terrain.chunkSize * terrain.chunkSize
+        else:
+            ret = self.w * self.h * (1 + 8 * 6)
+        return ret + len(self.soldiers) * 4096
+
+    def retainTerrain(self, area):
+        # lets chunked terrain release what's far from the area and from
+        # what the soldiers can see
+        areas = [area]
+        r = Battlefield.sightRange
+        for s in self.soldiers:
+            if s.alive():
+                areas.append((s.x - r, s.y - r, s.x + r, s.y + r))
+        self.terrain.retain(areas)
+
+    def reachMap(self, soldier):
+        rm = self.reachMaps.get(soldier)
+        if rm is None or not rm.valid():
+            rm = ReachMap(self, soldier)
+            self.reachMaps[soldier] = rm
+        return rm
+
+    def _enclosed(self, pos, start):
+        x, y = pos
+        if abs(x - start[0]) <= 1 and abs(y - start[1]) <= 1:
+            return False
+        for nx in xrange(max(0, x - 1), min(self.w, x + 2)):
+            for ny in xrange(max(0, y - 1), min(self.h, y + 2)):
+                if (nx != x or ny != y) and self.passable(nx, ny):
+                    return False
+        return True
 
     def passable(self, x, y):
-        if not self.terrain[x][y].passable():
+        if not self.terrain.passable(x, y):
             return False
         return self.soldierAt(x, y) == None
 
     def movementCost(self, x, y):
-        return self.terrain[x][y].movementCost()
+        return self.terrain.movementCost(x, y)
 
     def moveTo(self, x, y):
-        self.moveTarget = self.getPath(self.getCurrentSoldier().getPosition(), (x, y))
+        soldier = self.getCurrentSoldier()
+        rm = self.reachMaps.get(soldier)
+        if rm and rm.valid() and rm.reachable(x, y):
+            self.moveTarget = rm.pathTo(x, y)
+        else:
+            self.moveTarget = self.getPath(soldier.getPosition(), (x, y))
 
     def updateMovement(self):
         soldier = self.getCurrentSoldier()
@@ -781,16 +2694,21 @@ class Battlefield(object):
             self.moveTarget = None
             return True, set(), set()
 
-        soldiersSeenBefore = set(self.enemySoldiersSeenBySoldier(soldier))
-        itemsSeenBefore = set(self.itemsSeenBySoldier(soldier))
-
+        fovBefore = self.fieldOfView(soldier)
         soldier.setPosition(nextStep)
-
-        soldiersSeenAfter = set(self.enemySoldiersSeenBySoldier(soldier))
-        itemsSeenAfter = set(self.itemsSeenBySoldier(soldier))
-
-        newSoldiersSeen = soldiersSeenAfter - soldiersSeenBefore
-        newItemsSeen = itemsSeenAfter - itemsSeenBefore
+        fovAfter = self.fieldOfView(soldier)
+
+        # only what's on newly visible tiles can be newly seen
+        newSoldiersSeen = set()
+        newItemsSeen = set()
+        for i in fovAfter.newlyVisible(fovBefore):
+            s = self.occupancy.atIndex(i)
+            if s and s.team != soldier.team:
+                newSoldiersSeen.add(s)
+            pos = self.terrain.coord(i)
+            if pos in self.items:
+                for it in self.items[pos]:
+                    newItemsSeen.add((pos, it))
         return None, newSoldiersSeen, newItemsSeen
 
     def endTurn(self):
@@ -813,6 +2731,8 @@ class Battlefield(object):
             self.currentSoldier = prevCurrentSoldier
             return True
         assert self.currentSoldier is not None
+        self._markSoldier(prevCurrentSoldier)
+        self._markSoldier(self.currentSoldier)
 
         assert currentTeam != nextTeam
         for l in self.listeners:
@@ -832,8 +2752,7 @@ class Battlefield(object):
             return False
 
         soldpos = sold.getPosition()
-        shootLine = getLine(soldpos[0], soldpos[1], x, y)
-        self.shootLine = shootLine[1:10]
+        self.shootLine = list(iterLine(soldpos[0], soldpos[1], x, y, 1, 10))
         self.shotDistance = 0
         return True
 
@@ -854,7 +2773,7 @@ class Battlefield(object):
             self.checkFriendly()
             return x, y, hit
         else:
-            ol = self.terrain[x][y].overlay
+            ol = self.terrain.overlay(x, y)
             if self.shotDistance > 10: # TODO: weapon dependent
                 self.shootLine = None
                 return x, y, None
@@ -873,13 +2792,18 @@ class Battlefield(object):
                 return None
 
     def addItem(self, item, position):
+        if position not in self.items:
+            self.itemIndex.add(position, position)
         self.items[position].append(item)
+        self.dirtyCells.add(position)
 
     def removeItem(self, item, position):
         items = self.items[position]
         items.remove(item)
         if len(items) == 0:
             del self.items[position]
+            self.itemIndex.remove(position)
+        self.dirtyCells.add(position)
 
     def itemsAt(self, x, y):
         if (x, y) in self.items:
@@ -887,14 +2811,19 @@ class Battlefield(object):
         else:
             return list()
 
-    def itemsSeenByTeam(self, teamnum):
+    def itemsSeenByTeam(self, teamnum, area=None):
+        # area limits the search to (x0, y0, x1, y1)
+        tv = self.teamVisibility(teamnum)
+        if area:
+            candidates = self.itemIndex.inArea(*area)
+        else:
+            candidates = set()
+            for s in self.soldiersInTeam(teamnum):
+                candidates.update(self.itemIndex.near(s.getPosition(), Battlefield.sightRange))
         ret = dict()
-        slist = self.soldiersInTeam(teamnum)
-        for pos, items in self.items.items():
-            for s in slist:
-                if self.visibilityTo(s, pos) > 0.0:
-                    ret[pos] = items
-                    break
+        for pos in candidates:
+            if tv.sees(pos):
+                ret[pos] = self.items[pos]
         return ret
 
     def soldiersInTeam(self, teamnum):
@@ -903,52 +2832,49 @@ class Battlefield(object):
     def soldierSeenByTeam(self, teamnum, soldier):
         if not soldier.alive():
             return False
-        pos = soldier.getPosition()
-        for s in self.soldiersInTeam(teamnum):
-            if self.visibilityTo(s, pos) > 0.0:
-                return True
-        return False
+        return self.teamVisibility(teamnum).sees(soldier.getPosition())
 
     def enemySoldiersSeenByTeam(self, teamnum):
+        tv = self.teamVisibility(teamnum)
+        enemyTeam = 1 if teamnum == 0 else 0
         ret = set()
         for s in self.soldiersInTeam(teamnum):
-            for n in self.enemySoldiersSeenBySoldier(s):
-                ret.add(n)
+            for n in self.soldierIndex.near(s.getPosition(), Battlefield.sightRange):
+                if n.team == enemyTeam and tv.sees(n.getPosition()):
+                    ret.add(n)
         return ret
 
     def enemySoldiersSeenBySoldier(self, soldier):
         ret = list()
         enemyTeam = 1 if soldier.team == 0 else 0
-        for s in self.soldiersInTeam(enemyTeam):
-            if self.visibilityTo(soldier, s.getPosition()) > 0.0:
+        fov = self.fieldOfView(soldier)
+        for s in self.soldierIndex.near(soldier.getPosition(), Battlefield.sightRange):
+            if s.team == enemyTeam and fov.sees(s.getPosition()):
                 ret.append(s)
         return ret
 
     def itemsSeenBySoldier(self, soldier):
         ret = list()
-        pos = soldier.getPosition()
-        for pos, items in self.items.items():
-            if self.visibilityTo(soldier, pos) > 0.0:
-                for it in items:
+        fov = self.fieldOfView(soldier)
+        for pos in self.itemIndex.near(soldier.getPosition(), Battlefield.sightRange):
+            if fov.sees(pos):
+                for it in self.items[pos]:
                     ret.append((pos, it))
         return ret
 
+    def fieldOfView(self, soldier):
+        pos = soldier.getPosition()
+        try:
+            key, fov = self.fieldsOfView[soldier]
+        except KeyError:
+            key = None
+        if key != (pos, self.terrain.version):
+            fov = FieldOfView(self.terrain, pos, Battlefield.sightRange)
+            self.fieldsOfView[soldier] = (pos, self.terrain.version), fov
+        return fov
+
     def visibilityTo(self, soldier, position):
-        spos = soldier.getPosition()
-        line = getLine(spos[0], spos[1], position[0], position[1])[1:-1]
-        visibility = 1.0
-        for (lx, ly), e in line:
-            ol = self.terrain[lx][ly].overlay
-            if ol == Tile.Overlay.NoOverlay:
-                drop = 0.05
-            elif ol == Tile.Overlay.Tree:
-                drop = 0.35
-            elif ol == Tile.Overlay.Wall:
-                drop = 1.0
-            else:
-                assert False, 'No visibility information for %d' % ol
-            visibility -= drop
-        return visibility
+        return self.fieldOfView(soldier).visibility(position[0], position[1])
 
     def isFriendly(self):
         return self.friendly
@@ -972,52 +2898,82 @@ class Battlefield(object):
             return True
         else:
             for s in soldiers:
-                if direction == 1 and s.x > 5:
-                    return False
-                elif direction == 2 and s.y < self.h - 5:
-                    return False
-                elif direction == 3 and s.y > 5:
-                    return False
-                elif direction == 4 and s.x < self.w - 5:
+                if not self.inTravelBand(s, direction):
                     return False
             return True
 
+    def inTravelBand(self, soldier, direction):
+        if direction == 1:
+            return soldier.x <= Battlefield.travelBand
+        elif direction == 2:
+            return soldier.y >= self.h - Battlefield.travelBand
+        elif direction == 3:
+            return soldier.y <= Battlefield.travelBand
+        else:
+            return soldier.x >= self.w - Battlefield.travelBand
+
+    def nearEdge(self, direction):
+        # whether any of the player's soldiers is close to the edge
+        for s in self.soldiersInTeam(0):
+            if self.inTravelBand(s, direction):
+                return True
+        return False
+
     def checkFriendly(self):
         self.friendly = len(self.soldiersInTeam(1)) == 0
         return self.friendly
 
-def getLine(x0, y0, x1, y1):
-    # Bresenham
-    dx = abs(x1 - x0)
-    dy = abs(y1 - y0)
-    if x0 < x1:
+def _bresenham(dx, dy):
+    # offsets and error terms of the line from (0, 0) to (dx, dy)
+    x0, y0 = 0, 0
+    adx = abs(dx)
+    ady = abs(dy)
+    if 0 < dx:
         sx = 1
     else:
         sx = -1
-    if y0 < y1:
+    if 0 < dy:
         sy = 1
     else:
         sy = -1
-    err = dx - dy
+    err = adx - ady
     origErr = err
 
     ret = list()
-    errRet = list()
-
     while True:
-        if x0 == x1 and y0 == y1:
-            errRet.append(0)
-        else:
-            errRet.append(abs((origErr - err) / float(max(dx, dy))))
-        ret.append((x0, y0))
-        if x0 == x1 and y0 == y1:
-            return zip(ret, errRet)
+        if x0 == dx and y0 == dy:
+            ret.append((x0, y0, 0))
+            return tuple(ret)
+        ret.append((x0, y0, abs((origErr - err) / float(max(adx, ady)))))
         e2 = 2 * err
-        if e2 > -dy:
-            err = err - dy
+        if e2 > -ady:
+            err = err - ady
             x0 = x0 + sx
-        if e2 < dx:
-            err = err + dx
+        if e2 < adx:
+            err = err + adx
             y0 = y0 + sy
 
+_rayTemplates = dict()
+maxRayTemplates = 8192
+
+def rayTemplate(dx, dy):
+    # Bresenham lines only depend on the difference between their end
+    # points, so they're cached as relative offsets
+    key = dx, dy
+    try:
+        return _rayTemplates[key]
+    except KeyError:
+        pass
+    if len(_rayTemplates) >= maxRayTemplates:
+        _rayTemplates.clear()
+    template = _bresenham(dx, dy)
+    _rayTemplates[key] = template
+    return template
+
+def getLine(x0, y0, x1, y1):
+    return [((x0 + ox, y0 + oy), err) for ox, oy, err in rayTemplate(x1 - x0, y1 - y0)]
 
+def iterLine(x0, y0, x1, y1, start=0, stop=None):
+    # like getLine(x0, y0, x1, y1)[start:stop] but without building the list
+    for ox, oy, err in itertools.islice(rayTemplate(x1 - x0, y1 - y0), start, stop):
+        yield (x0 + ox, y0 + oy), err
@@ -0,0 +1,46 @@
+#!/usr/bin/env python2.7
+
+import unittest
+
+# log removes the previous log on import
+open('debug.log', 'a').close()
+
+import model
+from model import Tile
+
+class ChunkedPathTest(unittest.TestCase):
+    size = 1024
+
+    def setUp(self):
+        cs = model.ChunkedTerrainGrid.defaultChunkSize
+        grass = model.TerrainGrid(cs, cs).cells
+        self.bf = model.Battlefield(self.size, self.size, True)
+        self.bf.terrain = model.ChunkedTerrainGrid(self.size, self.size, lambda cx, cy: bytearray(grass))
+
+    def ring(self, x0, y0, x1, y1):
+        # trees around the area
+        for x in xrange(x0 - 1, x1 + 2):
+            for y in xrange(y0 - 1, y1 + 2):
+                if x < x0 or y < y0 or x > x1 or y > y1:
+                    self.bf.terrain.set(x, y, Tile.Base.Grass, Tile.Overlay.Tree)
+
+    def testEnclosedPocket(self):
+        # the goal is passable but can't be reached, which chunked terrain
+        # can't tell without searching
+        self.ring(510, 500, 511, 500)
+        self.assertEqual(self.bf.getPath((500, 500), (510, 500)), None)
+        # the search stopped at its largest window instead of the sector
+        self.assertTrue(len(self.bf.terrain.chunks) < 100)
+        self.assertTrue(self.bf.windowSolver.w < 300)
+
+    def testDetour(self):
+        # a wall with a gap beyond the first search window
+        for x in xrange(350, 651):
+            if x != 600:
+                self.bf.terrain.set(x, 503, Tile.Base.Floor, Tile.Overlay.Wall)
+        path = self.bf.getPath((500, 500), (500, 506))
+        self.assertNotEqual(path, None)
+        self.assertTrue((600, 503) in path)
+
+if __name__ == '__main__':
+    unittest.main()
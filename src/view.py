@@ -2,6 +2,7 @@
 
 import curses
 import os
+import time
 import argparse
 import cPickle as pickle
 
@@ -9,36 +10,36 @@ import model
 import controller
 
 class Path(object):
-    def __init__(self, bf, start, end):
+    def __init__(self, bf):
         self.bf = bf
-        self.start = start
-        self.end = end
-        self.path = self.bf.getPath(self.start, self.end)
-        self.calcPathCost()
-
-    def calcPathCost(self):
-        path_cost = None
-        if self.path:
-            path_cost = [0]
-            curr_path_cost = 0
-            for n in self.path[1:]:
-                curr_path_cost += self.bf.movementCost(n[0], n[1])
-                path_cost.append(curr_path_cost)
-            self.path = zip(self.path, path_cost)
+        self.soldier = None
+        self.end = None
+        self.reachMap = None
+        self.path = None
 
     def getPath(self):
         return self.path
 
-    def changeCoord(self, start, end):
-        if start != self.start or end != self.end:
-            self.start = start
-            self.end = end
-            self.path = self.bf.getPath(self.start, self.end)
-            self.calcPathCost()
+    def isFor(self, soldier, end):
+        return soldier is self.soldier and end == self.end
+
+    def changeTarget(self, soldier, end):
+        # the reach map is replaced whenever the soldier or anyone else moves
+        reachMap = self.bf.reachMap(soldier)
+        if soldier is self.soldier and end == self.end and reachMap is self.reachMap:
+            return
+        self.soldier = soldier
+        self.end = end
+        self.reachMap = reachMap
+        self.path = reachMap.pathWithCostsTo(end[0], end[1])
+        if self.path is None and not reachMap.complete():
+            # further than the APs allow, but may still be reachable
+            self.path = self.bf.getPathWithCosts(soldier.getPosition(), end)
 
 class View(object):
-    def __init__(self, stdscr, seed, island):
+    def __init__(self, stdscr, seed, island, animSpeed=1.0):
         self.stdscr = stdscr
+        self.animSpeed = animSpeed
         if island:
             self.island = island
         else:
@@ -64,13 +65,14 @@ class View(object):
         curses.init_pair(11, 33, 7) # soldier team 1, selected
 
         self.stdscr.leaveok(0)
-        self.view = BattlefieldView(self.stdscr, self.island, self.island)
+        self.view = BattlefieldView(self.stdscr, self.island, self.island, self.animSpeed)
 
     def run(self):
         while True:
             ret = self.view.run()
             if ret == 0:
                 # cleanup
+                self.island.stopPrefetching()
                 curses.nocbreak()
                 self.stdscr.keypad(0)
                 curses.echo()
@@ -79,22 +81,33 @@ class View(object):
             else:
                 travelled = self.island.travel(ret)
                 if travelled:
-                    self.view = BattlefieldView(self.stdscr, self.island, self.island)
+                    self.view = BattlefieldView(self.stdscr, self.island, self.island, self.animSpeed)
 
 class BattlefieldView(object):
     infobarHeight = 4
     statusbarHeight = 2
     leftPanelWidth = 14
     rightPanelWidth = 14
-    shotAnimDelay = 1
-    walkAnimDelay = 20
-
-    def __init__(self, stdscr, island, saveable):
+    # seconds from one step of an animation to the next at normal speed
+    shotStepTime = 0.03
+    walkStepTime = 0.08
+    # how long the cursor needs to stay put for the path to it to be shown,
+    # so that holding down a key doesn't search for a path at every step
+    pathDelay = 0.06
+    # see makeTileGlyphs()
+    tileGlyphs = None
+
+    def __init__(self, stdscr, island, saveable, animSpeed=1.0):
         self.stdscr = stdscr
         self.island = island
         self.bf = self.island.getCurrentBattlefield()
-        self.path = Path(self.bf, (0, 0), (0, 0))
-        self.animDelay = 0
+        self.path = Path(self.bf)
+        # 0 skips animations
+        self.animSpeed = animSpeed
+        self.nextAnimStep = 0
+        self.skipAnimation = False
+        self.lastKeyTime = 0
+        self.shownPath = None
         self.hitPoint = None
         self.screenOffset = 0, 0
         self.reportedSoldiers = set()
@@ -102,8 +115,42 @@ class BattlefieldView(object):
         self.winy, self.winx = self.stdscr.getmaxyx()
         self.running = True
 
+        # Each part of the screen is a window of its own, so that only the
+        # parts that changed need to be sent to the terminal. The map is a
+        # pad with the terrain drawn once and only redrawn where the
+        # battlefield says something changed, the rest only when their text
+        # changes.
+        panelHeight = self.winy - BattlefieldView.statusbarHeight - BattlefieldView.infobarHeight
+        if BattlefieldView.tileGlyphs is None:
+            BattlefieldView.tileGlyphs = BattlefieldView.makeTileGlyphs()
+        self.headerWin = curses.newwin(BattlefieldView.statusbarHeight, self.winx, 0, 0)
+        self.leftPanelWin = curses.newwin(panelHeight, BattlefieldView.leftPanelWidth,
+                BattlefieldView.statusbarHeight, 0)
+        self.rightPanelWin = curses.newwin(panelHeight, BattlefieldView.rightPanelWidth,
+                BattlefieldView.statusbarHeight, self.winx - BattlefieldView.rightPanelWidth)
+        self.mapPad = self.newMapPad()
+        self.infobarWin = curses.newwin(BattlefieldView.infobarHeight, self.winx,
+                self.winy - BattlefieldView.infobarHeight, 0)
+        # the stats are wider than the side panels and drawn over them
+        self.statsWins = [curses.newwin(panelHeight, 20, BattlefieldView.statusbarHeight, 0),
+                curses.newwin(panelHeight, 19, BattlefieldView.statusbarHeight, self.winx - 19)]
+        # the inventory and pickup menu, sized to the list when shown
+        self.itemWin = curses.newwin(1, 31, 5, 30)
+        self.mapPad.keypad(1)
+        # (window, size) of the overlays on screen
+        self.overlays = list()
+        # what's on screen
+        self.padOrigin = None
+        self.stampedCells = None
+        self.drawnTerrainVersion = None
+        self.drawnDecorations = dict()
+        self.drawnHeader = None
+        self.drawnInfobar = None
+        # everything is drawn the first time anyway
+        self.bf.takeDirty()
+
         self.controller = controller.Controller(self.bf, saveable)
-        self.ai = model.TeamAI(self.bf)
+        self.ai = self.island.getCurrentTeamAI()
 
     def run(self):
         # initialise coroutines
@@ -117,25 +164,22 @@ class BattlefieldView(object):
         self.centerScreenTo(cp)
 
         while self.running:
-            self.draw()
+            # skipped animations are only drawn once they're over
+            if not (self.skipAnimation and self.animating()):
+                self.draw()
             self.getInput(g, ai)
+            self.island.prefetchNeighbours()
             if self.controller.cflags.travelling:
                 t = self.controller.cflags.travelling
                 self.controller.cflags.travelling = 0
                 if not self.bf.travelAllowed(t) or not self.island.travelAllowed(t):
                     self.controller.cstate.message = 'Cannot travel there...'
                 else:
+                    self.bf.removeListener(self.controller)
                     return t
 
         return 0
 
-    def posOnScreen(self, pos):
-        cpx, cpy = pos
-        return cpx - self.screenOffset[0] + BattlefieldView.leftPanelWidth, cpy - self.screenOffset[1] + BattlefieldView.statusbarHeight
-
-    def cursorPosOnScreen(self):
-        return self.posOnScreen(self.controller.cstate.cursorpos)
-
     def checkCenter(self):
         if self.controller.cflags.center == True:
             self.controller.cflags.center = False
@@ -157,58 +201,147 @@ class BattlefieldView(object):
     def centerScreenTo(self, cp):
         self.screenOffset = self.possibleCenterOffset(cp)
 
-    def drawItems(self):
-        for pos, items in self.bf.itemsSeenByTeam(0).items():
-            item = items[0]
-            char, color, attr = self.itemDisplay(item)
-            self.addch(pos, char, color, attr)
-
-    def drawPeople(self):
-        for sold in self.bf.soldiers:
-            if not sold.alive():
-                continue
-            char = '@'
+    def viewArea(self):
+        # battlefield coordinates visible in the main window, edges included
+        x1 = min(self.mainWindowWidth() + self.screenOffset[0] + 1, self.bf.w) - 1
+        y1 = min(self.mainWindowHeight() + self.screenOffset[1] + 1, self.bf.h) - 1
+        return self.screenOffset[0], self.screenOffset[1], x1, y1
+
+    def newMapPad(self):
+        # The whole battlefield fits in the pad and scrolling only changes
+        # the part of it that's shown. Chunked battlefields can be too large
+        # for that, so their pad only covers the main window and is redrawn
+        # when it scrolls. The pad is one column wider than what's shown so
+        # that its bottom right corner is never written to.
+        h = self.mainWindowHeight() + 1
+        w = self.mainWindowWidth() + 1
+        if not self.bf.terrain.chunked:
+            h = max(h, self.bf.h)
+            w = max(w, self.bf.w)
+        return curses.newpad(h, w + 1)
+
+    def padArea(self):
+        # battlefield coordinates that can be drawn on the pad
+        if self.bf.terrain.chunked:
+            return self.viewArea()
+        return 0, 0, self.bf.w - 1, self.bf.h - 1
+
+    def drawMap(self, dirtyCells):
+        decorations = self.decorations()
+        terrain = self.bf.terrain
+        # what was under the old decorations shows again
+        cells = dirtyCells
+        cells.update(self.drawnDecorations)
+        cells.update(decorations)
+        if self.padOrigin is None or (terrain.chunked and (self.padOrigin != self.screenOffset or
+                self.drawnTerrainVersion != terrain.version)):
+            self.padOrigin = self.padArea()[0:2]
+            self.drawnTerrainVersion = terrain.version
+            area = self.padArea()
+            self.mapPad.erase()
+            self.drawTerrain(area)
+            cells.update(self.bf.itemsSeenByTeam(0, area))
+            cells.update(s.getPosition() for s in self.bf.soldiersIn(area))
+            if not terrain.chunked:
+                self.stampedCells = bytearray(terrain.cells)
+        elif self.drawnTerrainVersion != terrain.version:
+            self.drawnTerrainVersion = terrain.version
+            cells.update(self.editedTiles())
+        x0, y0, x1, y1 = self.padArea()
+        for pos in cells:
+            if pos[0] >= x0 and pos[1] >= y0 and pos[0] <= x1 and pos[1] <= y1:
+                char, attr = self.cellDisplay(pos, decorations)
+                self.addch(pos, char, attr)
+        self.drawnDecorations = decorations
+
+    def editedTiles(self):
+        # the tiles that differ from what was last drawn on flat terrain,
+        # compared a column at a time
+        cells = self.bf.terrain.cells
+        stamped = self.stampedCells
+        h = self.bf.h
+        ret = list()
+        for x in xrange(self.bf.w):
+            start = x * h
+            if cells[start:start + h] != stamped[start:start + h]:
+                for y in xrange(h):
+                    if cells[start + y] != stamped[start + y]:
+                        ret.append((x, y))
+        self.stampedCells = bytearray(cells)
+        return ret
+
+    def cellDisplay(self, pos, decorations):
+        # the character and attributes of what's on top at the position
+        try:
+            return decorations[pos]
+        except KeyError:
+            pass
+        x, y = pos
+        sold = self.bf.soldierAt(x, y)
+        if sold:
             if sold.team == 0:
                 if sold == self.bf.getCurrentSoldier():
-                    color = 11
+                    return '@', curses.color_pair(11)
                 else:
-                    color = 1
+                    return '@', curses.color_pair(1)
             elif self.bf.soldierSeenByTeam(0, sold):
-                color = 2
-            else:
-                continue
-            self.addch(sold.getPosition(), char, color, 0)
-
-    def drawTerrain(self):
-        for x in xrange(self.screenOffset[0], min(self.mainWindowWidth() + self.screenOffset[0] + 1, self.bf.w)):
-            for y in xrange(self.screenOffset[1], min(self.mainWindowHeight() + self.screenOffset[1] + 1, self.bf.h)):
-                terr = self.bf.terrain[x][y]
-                attr = 0
-                if terr.overlay == model.Tile.Overlay.Tree:
-                    char = 'T'
-                    color = 3
-                elif terr.overlay == model.Tile.Overlay.Wall:
-                    char = 'w'
-                    color = 9
-                    attr = curses.A_BOLD
-                elif terr.base == model.Tile.Base.Water:
-                    char = '~'
-                    color = 8
-                elif terr.base == model.Tile.Base.Grass:
-                    char = '.'
-                    color = 4
-                elif terr.base == model.Tile.Base.Grass:
-                    char = '.'
-                    color = 4
-                elif terr.base == model.Tile.Base.Floor:
-                    char = '.'
-                    color = 10
-                elif terr.base == model.Tile.Base.Pathway:
-                    char = '+'
-                    color = 122
-                else:
-                    assert False, 'Can\'t display base %d, overlay %d' % (terr.base, terr.overlay)
-                self.addch((x, y), char, color, attr)
+                return '@', curses.color_pair(2)
+        items = self.bf.itemsAt(x, y)
+        if items and self.bf.teamVisibility(0).sees(pos):
+            char, color, attr = self.itemDisplay(items[0])
+            return char, curses.color_pair(color) | attr
+        return BattlefieldView.tileGlyphs[self.bf.terrain.cell(x, y)]
+
+    def drawTerrain(self, area):
+        # chunked terrain is read through a flat copy of the area
+        grid, ox, oy = self.bf.terrain.window(*area)
+        cells = grid.cells
+        glyphs = BattlefieldView.tileGlyphs
+        pad = self.mapPad
+        px, py = self.padOrigin
+        x0, y0, x1, y1 = area
+        for x in xrange(x0, x1 + 1):
+            col = (x - ox) * grid.h - oy
+            for y in xrange(y0, y1 + 1):
+                char, attr = glyphs[cells[col + y]]
+                pad.addch(y - py, x - px, char, attr)
+
+    @staticmethod
+    def makeTileGlyphs():
+        # character and attributes for every packed terrain cell; the color
+        # pairs need to be set up first
+        ret = list()
+        for cell in xrange(256):
+            char, color, attr = BattlefieldView.tileDisplay(cell & model.TerrainGrid.BaseMask,
+                    cell >> model.TerrainGrid.OverlayShift)
+            ret.append((char, curses.color_pair(color) | attr))
+        return ret
+
+    @staticmethod
+    def tileDisplay(base, overlay):
+        attr = 0
+        if overlay == model.Tile.Overlay.Tree:
+            char = 'T'
+            color = 3
+        elif overlay == model.Tile.Overlay.Wall:
+            char = 'w'
+            color = 9
+            attr = curses.A_BOLD
+        elif base == model.Tile.Base.Water:
+            char = '~'
+            color = 8
+        elif base == model.Tile.Base.Grass:
+            char = '.'
+            color = 4
+        elif base == model.Tile.Base.Floor:
+            char = '.'
+            color = 10
+        elif base == model.Tile.Base.Pathway:
+            char = '+'
+            color = 122
+        else:
+            assert False, 'Can\'t display base %d, overlay %d' % (base, overlay)
+        return char, color, attr
 
     @staticmethod
     def itemDisplay(item):
@@ -233,26 +366,28 @@ class BattlefieldView(object):
             msg = self.controller.cstate.message[:79]
         else:
             msg = ''
-        self.stdscr.addstr(0, 0, '%-80s' % msg)
-        self.stdscr.addstr(1, self.winx - 10, '%02d:%02d' % (self.island.time.hours, self.island.time.minutes))
+        header = msg, self.island.time.hours, self.island.time.minutes
+        if header == self.drawnHeader:
+            return
+        self.drawnHeader = header
+        self.headerWin.addstr(0, 0, '%-80s' % msg)
+        self.headerWin.addstr(1, self.winx - 10, '%02d:%02d' % header[1:])
+
+    def sidePanels(self):
+        # the player's soldiers, two on each side
+        team = [s for s in self.bf.soldiers if s.team == 0]
+        return [(self.leftPanelWin, 0, team[:2]), (self.rightPanelWin, 1, team[2:])]
 
-    def drawOnSidePanels(self, space, strfunc):
-        xpos = 0
-        ypos = BattlefieldView.statusbarHeight
-        ind = 0
+    def drawOnSidePanels(self, panels, space, strfunc):
         fmtstr = '%%-%ds' % (space - 1)
-        for sold in self.bf.soldiers:
-            if sold.team != 0:
-                continue
-
-            color, texts = strfunc(sold)
-            for text in texts:
-                self.stdscr.addstr(ypos, xpos, fmtstr % text, curses.color_pair(color))
-                ypos += 1
-            ind += 1
-            if ind == 2:
-                xpos = self.winx - space + 1
-                ypos = BattlefieldView.statusbarHeight
+        for win, xpos, solds in panels:
+            win.erase()
+            ypos = 0
+            for sold in solds:
+                color, texts = strfunc(sold)
+                for text in texts:
+                    win.addstr(ypos, xpos, fmtstr % text, curses.color_pair(color))
+                    ypos += 1
 
     def drawStats(self):
         def myfunc(sold):
@@ -268,9 +403,11 @@ class BattlefieldView(object):
             for i in xrange(2):
                 ret.append(' ' * (BattlefieldView.leftPanelWidth - 1))
             return 0, ret
-        self.drawOnSidePanels(20, myfunc)
+        panels = [(win, 0, solds) for win, (panel, x, solds) in zip(self.statsWins, self.sidePanels())]
+        self.drawOnSidePanels(panels, 20, myfunc)
+        return self.statsWins
 
-    def drawSidePanels(self):
+    def drawSidePanels(self, dirtyPanels):
         currsold = self.bf.getCurrentSoldier()
         def myfunc(sold):
             ret = list()
@@ -291,107 +428,135 @@ class BattlefieldView(object):
             return color, ret
 
         assert BattlefieldView.leftPanelWidth == BattlefieldView.rightPanelWidth
-        self.drawOnSidePanels(50, lambda x: (0, [''] * 5))
-        self.drawOnSidePanels(BattlefieldView.leftPanelWidth, myfunc)
+        if dirtyPanels is not None:
+            panels = [p for p in self.sidePanels() if dirtyPanels.intersection(p[2])]
+        else:
+            panels = self.sidePanels()
+        self.drawOnSidePanels(panels, BattlefieldView.leftPanelWidth, myfunc)
 
     def drawInfobar(self):
-        xpos = 0
-        ypos = self.winy - BattlefieldView.infobarHeight
         currsold = self.bf.getCurrentSoldier()
         if currsold.team == 0:
-            if self.path.getPath():
-                neededAPs = self.path.getPath()[-1][1]
+            if self.shownPath:
+                neededAPs = self.shownPath[-1][1]
                 infostr = 'Needed APs: %-4d' % neededAPs
             else:
                 infostr = '                    '
-            self.stdscr.addstr(ypos + 0, xpos, infostr)
 
             if self.controller.cstate.aiming != 0:
                 dist = self.bf.distance(currsold.getPosition(), self.controller.cstate.cursorpos)
                 shootstr = 'Shooting. Aim: %d, distance: %d     ' % (self.controller.cstate.aiming, dist)
             else:
                 shootstr = ' ' * 40
-            self.stdscr.addstr(ypos + 1, xpos, shootstr)
             coordTuple = (self.controller.cstate.cursorpos[0], self.controller.cstate.cursorpos[1], self.screenOffset[0], self.screenOffset[1])
-            self.stdscr.addstr(ypos + 2, xpos, '(%d, %d) (%d, %d)       ' % coordTuple)
-            self.stdscr.addstr(ypos + 3, xpos, '%d  ' % self.controller.cstate.pressedKeyCode)
-
-    def drawPath(self):
-        if self.bf.shootLine:
-            return
-        soldier = self.bf.getCurrentSoldier()
-        if soldier.team != 0:
-            return
-        self.path.changeCoord(soldier.getPosition(), self.controller.cstate.cursorpos)
-        if self.path.getPath():
-            for p in self.path.getPath()[1:]:
-                if p[1] < soldier.getAPs():
-                    color = 5
-                else:
-                    color = 6
-                self.addch(p[0], 'x', color)
+            lines = (infostr, shootstr, '(%d, %d) (%d, %d)       ' % coordTuple,
+                    '%d  ' % self.controller.cstate.pressedKeyCode)
+            if lines == self.drawnInfobar:
+                return
+            self.drawnInfobar = lines
+            for ypos, line in enumerate(lines):
+                self.infobarWin.addstr(ypos, 0, line)
+
+    def decorations(self):
+        # what's drawn on the map over the battlefield: the path or the
+        # bullet, by position
+        ret = dict()
+        self.shownPath = None
+        if self.hitPoint:
+            ret[self.hitPoint[0:2]] = '*', curses.color_pair(7)
+        elif self.bf.shootLine:
+            ret[self.bf.shootLine[0][0]] = '.', curses.color_pair(6)
+        else:
+            soldier = self.bf.getCurrentSoldier()
+            if soldier.team != 0 or self.pathWait() > 0:
+                return ret
+            self.path.changeTarget(soldier, self.controller.cstate.cursorpos)
+            self.shownPath = self.path.getPath()
+            if self.shownPath:
+                for p in self.shownPath[1:]:
+                    if p[1] < soldier.getAPs():
+                        color = 5
+                    else:
+                        color = 6
+                    ret[p[0]] = 'x', curses.color_pair(color)
+        return ret
 
     def drawOverlay(self):
+        # windows shown over the rest of the screen
         soldier = self.bf.getCurrentSoldier()
-        row = 5
+        overlays = list()
         if self.controller.cstate.showStats:
-            self.drawStats()
+            overlays.extend(self.drawStats())
         if self.controller.cstate.showInventory:
             inv = soldier.getInventory()
             showInv = True
-            if not inv:
-                msg = 'Inventory is empty.'
-                self.stdscr.addstr(row, 30, '%-30s' % msg)
-                return True
         elif self.controller.cstate.showPickupMenu:
             inv = self.controller.cstate.itemMenu
             showInv = False
         else:
-            return False
-
-        for k, v in sorted(inv.items()):
-            msg = '%c  %s%s' % (k, v.getName(), ' (wielded)' if showInv and k == soldier.wieldedItem else '')
-            self.stdscr.addstr(row, 30, '%-30s' % msg)
-            row += 1
-        return True
-
-    def addch(self, pos, ch, color, attr=0):
-        pos = self.posOnScreen(pos)
-        if pos[1] < self.winy - BattlefieldView.infobarHeight and \
-                pos[1] >= BattlefieldView.statusbarHeight and \
-                pos[0] < self.winx - BattlefieldView.rightPanelWidth and \
-                pos[0] >= BattlefieldView.leftPanelWidth:
-            self.stdscr.addch(pos[1], pos[0], ch, curses.color_pair(color) | attr)
-
-    def drawBullet(self):
-        if self.hitPoint:
-            self.addch(self.hitPoint[0:2], '*', 7)
-            return
-        sl = self.bf.shootLine
-        if not sl:
-            return
-        bt = sl[0][0]
-        self.addch(bt, '.', 6)
+            return overlays
+
+        if inv:
+            msgs = ['%c  %s%s' % (k, v.getName(), ' (wielded)' if showInv and k == soldier.wieldedItem else '')
+                    for k, v in sorted(inv.items())]
+        else:
+            msgs = ['Inventory is empty.']
+        # one column wider than the text, as curses can't write the bottom
+        # right corner of a window
+        win = self.itemWin
+        if win.getmaxyx()[0] != len(msgs):
+            win.resize(len(msgs), 31)
+        win.erase()
+        for row, msg in enumerate(msgs):
+            win.addstr(row, 0, '%-30s' % msg)
+        overlays.append(win)
+        return overlays
+
+    def addch(self, pos, ch, attr):
+        self.mapPad.addch(pos[1] - self.padOrigin[1], pos[0] - self.padOrigin[0], ch, attr)
 
     def draw(self):
         self.checkCenter()
-        self.drawSidePanels()
-        self.drawTerrain()
-        self.drawItems()
-        self.drawPeople()
-        self.drawPath()
-        self.drawBullet()
+        self.bf.retainTerrain(self.viewArea())
+        cells, panels = self.bf.takeDirty()
+        if self.padOrigin is None:
+            # nothing drawn yet
+            panels = None
+        self.drawSidePanels(panels)
+        self.drawMap(cells)
         self.drawInfobar()
         self.drawHeader()
-        if not self.drawOverlay():
-            cp = self.cursorPosOnScreen()
-            self.stdscr.move(cp[1], cp[0])
-        self.stdscr.refresh()
+        overlays = self.drawOverlay()
+        shown = [(win, win.getmaxyx()) for win in overlays]
+        if any(overlay not in shown for overlay in self.overlays):
+            # the windows still have what was under the overlays that are
+            # gone or smaller now
+            for win in (self.leftPanelWin, self.rightPanelWin, self.mapPad):
+                win.touchwin()
+        self.overlays = shown
+
+        for win in (self.headerWin, self.leftPanelWin, self.rightPanelWin, self.infobarWin):
+            win.noutrefresh()
+        px = self.screenOffset[0] - self.padOrigin[0]
+        py = self.screenOffset[1] - self.padOrigin[1]
+        if not overlays:
+            # the terminal cursor is left where the last window has it
+            cx, cy = self.controller.cstate.cursorpos
+            x0, y0, x1, y1 = self.padArea()
+            if cx >= x0 and cy >= y0 and cx <= x1 and cy <= y1:
+                self.mapPad.move(cy - self.padOrigin[1], cx - self.padOrigin[0])
+        self.mapPad.noutrefresh(py, px, BattlefieldView.statusbarHeight, BattlefieldView.leftPanelWidth,
+                BattlefieldView.statusbarHeight + self.mainWindowHeight(),
+                BattlefieldView.leftPanelWidth + self.mainWindowWidth())
+        for win in overlays:
+            win.touchwin()
+            win.noutrefresh()
+        curses.doupdate()
 
     def getInput(self, g, ai):
         if not self.bf.soldiersInTeam(0) and not self.bf.isFriendly():
             self.controller.cstate.message = 'Sector lost!'
-            c = self.stdscr.getch()
+            c = self.mapPad.getch()
             self.running = c != ord('q')
             return
 
@@ -399,43 +564,115 @@ class BattlefieldView(object):
         if soldier.team != 0:
             ai.send(None)
 
-        if self.bf.moveTarget or self.bf.shootLine or self.hitPoint:
+        if self.animating():
             self._animate()
         else:
+            self.skipAnimation = False
             if soldier.team == 0:
                 curses.curs_set(1)
-                c = self.stdscr.getch()
-                g.send(c)
-                self.running = self.controller.cflags.running
-                if self.controller.cflags.turnEnded:
-                    self.controller.cflags.turnEnded = False
-                    self.island.progressTime()
-                if self.controller.cflags.droppedItem is not None:
-                    self.reportedItems.add(self.controller.cflags.droppedItem)
-                    self.controller.cflags.droppedItem = None
-                self.adjustCenter(self.controller.cstate.cursorpos)
-                self.checkScreenScroll()
+                wait = self.pathWait()
+                if wait > 0:
+                    # back to drawing the path if no key comes before then
+                    self.mapPad.timeout(int(wait * 1000) + 1)
+                c = self.mapPad.getch()
+                self.mapPad.timeout(-1)
+                if c == -1:
+                    return
+                # all the keys that are already waiting are handled before
+                # drawing again, as long as they're still for the player
+                while True:
+                    self._handleKey(g, c)
+                    if not self._takesKeys():
+                        break
+                    self.mapPad.nodelay(1)
+                    c = self.mapPad.getch()
+                    self.mapPad.nodelay(0)
+                    if c == -1:
+                        break
+                self.lastKeyTime = time.time()
+
+    def _handleKey(self, g, c):
+        g.send(c)
+        self.running = self.controller.cflags.running
+        if self.controller.cflags.turnEnded:
+            self.controller.cflags.turnEnded = False
+            self.island.progressTime()
+        if self.controller.cflags.droppedItem is not None:
+            self.reportedItems.add(self.controller.cflags.droppedItem)
+            self.controller.cflags.droppedItem = None
+        self.adjustCenter(self.controller.cstate.cursorpos)
+        self.checkScreenScroll()
+
+    def _takesKeys(self):
+        return self.running and not self.controller.cflags.travelling and \
+                not self.animating() and self.bf.getCurrentSoldier().team == 0
+
+    def pathWait(self):
+        # how long until the path to the cursor can be searched for, if it
+        # hasn't been already
+        if self.path.isFor(self.bf.getCurrentSoldier(), self.controller.cstate.cursorpos):
+            return 0
+        return self.lastKeyTime + BattlefieldView.pathDelay - time.time()
+
+    def animating(self):
+        return self.bf.moveTarget or self.bf.shootLine or self.hitPoint
 
     def _animate(self):
         curses.curs_set(0)
-        if self.animDelay > 0:
-            self.animDelay -= 1
+        if self.animSpeed == 0:
+            self.skipAnimation = True
+        if not self.skipAnimation and self._animShown():
+            self._waitForAnimStep()
+        self._animStep()
+        # what the player can't see is done all at once
+        while self.animating() and not self._animShown():
+            self._animStep()
+
+    def _animShown(self):
+        # whether the player sees what the animation shows until its next
+        # step: the moving soldier, the bullet or where it hit
+        soldier = self.bf.getCurrentSoldier()
+        if soldier.team == 0:
+            return True
+        tv = self.bf.teamVisibility(0)
+        if self.hitPoint:
+            return tv.sees(self.hitPoint[0:2])
+        elif self.bf.moveTarget:
+            return self.bf.soldierSeenByTeam(0, soldier)
+        elif self.bf.shootLine:
+            return tv.sees(self.bf.shootLine[0][0])
+        return False
+
+    def _animStep(self):
+        self.hitPoint = None
+        if self.bf.moveTarget:
+            stepTime = BattlefieldView.walkStepTime
+            self._animateMovement()
         else:
-            self.hitPoint = None
-            if self.bf.moveTarget:
-                self._animateMovement()
-            else:
-                self.animDelay = BattlefieldView.shotAnimDelay
-                if self.bf.shootLine:
-                    self.hitPoint = self.bf.updateShot()
-                    if self.hitPoint:
-                        soldierHit = self.hitPoint[2]
-                        if soldierHit:
-                            self.controller.cstate.message = 'Hit %s!' % soldierHit.getName()
+            stepTime = BattlefieldView.shotStepTime
+            if self.bf.shootLine:
+                self.hitPoint = self.bf.updateShot()
+                if self.hitPoint:
+                    soldierHit = self.hitPoint[2]
+                    if soldierHit:
+                        self.controller.cstate.message = 'Hit %s!' % soldierHit.getName()
+        if self.animSpeed:
+            self.nextAnimStep = time.time() + stepTime / self.animSpeed
+
+    def _waitForAnimStep(self):
+        # Sleeps until the next step is due. A key pressed in the meantime
+        # skips the rest of the animation.
+        wait = self.nextAnimStep - time.time()
+        if wait <= 0:
+            return
+        self.mapPad.timeout(int(wait * 1000) + 1)
+        c = self.mapPad.getch()
+        self.mapPad.timeout(-1)
+        if c != -1:
+            self.skipAnimation = True
 
     def _animateMovement(self):
         soldier = self.bf.getCurrentSoldier()
-        self.animDelay = BattlefieldView.walkAnimDelay
         self.reportedSoldiers = self.bf.enemySoldiersSeenByTeam(0)
         noaps, newSoldiers, newItems = self.bf.updateMovement()
         if soldier.team == 0:
@@ -492,13 +729,14 @@ class BattlefieldView(object):
         self.screenOffset = sx, sy
 
 
-def main(stdscr, seed, loadfile):
-    if loadfile:
-        with open(loadfile, 'rb') as f:
+def main(stdscr, args):
+    if args.loadfile:
+        with open(args.loadfile, 'rb') as f:
             island = pickle.load(f)
     else:
-        island = None
-    view = View(stdscr, seed, island)
+        island = model.Island(args.seed, args.workers, args.cacheDir, args.sectorCacheDir,
+                args.islandSize, args.sectorMemory * 1024 * 1024, args.spillDir, args.sectorSize)
+    view = View(stdscr, args.seed, island, args.animSpeed)
     view.run()
 
 if __name__ == '__main__':
@@ -507,6 +745,22 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('-s', '--seed', help='random seed', type=int, default=231, dest='seed')
     parser.add_argument('-l', '--load', help='load game', type=str, default=None, dest='loadfile')
+    parser.add_argument('-j', '--workers', help='generate all sectors up front using this many processes (default: generate each sector on entry)',
+            type=int, default=0, dest='workers')
+    parser.add_argument('-c', '--cache', help='world generation stage cache directory (see worldgen.py)',
+            type=str, default=None, dest='cacheDir')
+    parser.add_argument('--sector-cache', help='directory to keep generated sectors in between runs (default: generate them every time)',
+            type=str, default=None, dest='sectorCacheDir')
+    parser.add_argument('--island-size', help='island size in sectors, WxH (default: 3x4)',
+            type=model.parseIslandSize, default=None, dest='islandSize')
+    parser.add_argument('--sector-size', help='sector size in tiles, WxH (default: 80x40); large sectors are generated in chunks as they are explored',
+            type=model.parseSectorSize, default=None, dest='sectorSize')
+    parser.add_argument('--anim-speed', help='animation speed relative to normal; 0 skips animations (default: %(default)s)',
+            type=float, default=1.0, dest='animSpeed')
+    parser.add_argument('--sector-memory', help='megabytes of sectors to keep in memory; the rest are spilled to disk (default: %(default)s)',
+            type=int, default=model.SectorStore.defaultMemoryBudget // (1024 * 1024), dest='sectorMemory')
+    parser.add_argument('--spill-dir', help='directory for spilled sectors (default: a temporary directory)',
+            type=str, default=None, dest='spillDir')
     args = parser.parse_args()
-    curses.wrapper(lambda stdscr: main(stdscr, args.seed, args.loadfile))
+    curses.wrapper(lambda stdscr: main(stdscr, args))
 
@@ -0,0 +1,45 @@
+#!/usr/bin/env python2.7
+
+import os
+import argparse
+
+import model
+
+def sectorLocations(islandSize):
+    for i in xrange(islandSize[0]):
+        for j in xrange(islandSize[1]):
+            yield i, j
+
+def build(args):
+    island = model.Island(args.seed, max(1, args.workers), args.cache, islandSize=args.islandSize,
+            sectorSize=args.sectorSize)
+    print 'Built %d sectors for seed %d in %s' % (len(island.sectors), args.seed, args.cache)
+
+def inspect(args):
+    print 'Seed %d, cache %s' % (args.seed, args.cache)
+    startSector = model.Island.startSectorFor(args.islandSize)
+    for loc in sectorLocations(args.islandSize):
+        gen = model.SectorGenerator(args.seed, loc, args.islandSize, startSector, args.cache, args.sectorSize)
+        print 'Sector %d, %d' % loc
+        for stage, key in zip(gen.stages, gen.stageKeys()):
+            if gen.cached(key):
+                status = '%d bytes' % os.path.getsize(gen.cachePath(key))
+            else:
+                status = 'not cached'
+            print '    %-45s %s  %s' % (stage.describe(), key[:12], status)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='pre-build and inspect world generation stage caches')
+    parser.add_argument('command', choices=['build', 'inspect'])
+    parser.add_argument('-s', '--seed', help='random seed', type=int, default=231, dest='seed')
+    parser.add_argument('-c', '--cache', help='stage cache directory', type=str, default='worldcache', dest='cache')
+    parser.add_argument('--island-size', help='island size in sectors, WxH (default: 3x4)',
+            type=model.parseIslandSize, default=model.Island.defaultSize, dest='islandSize')
+    parser.add_argument('--sector-size', help='sector size in tiles, WxH (default: 80x40)',
+            type=model.parseSectorSize, default=model.Battlefield.defaultSize, dest='sectorSize')
+    parser.add_argument('-j', '--workers', help='number of processes to build with', type=int, default=1, dest='workers')
+    args = parser.parse_args()
+    if args.command == 'build':
+        build(args)
+    else:
+        inspect(args)